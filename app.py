@@ -1,10 +1,20 @@
 from dash.dependencies import Input, Output, State
+from flask import request, jsonify, Response
+import logging
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
-import pandas as pd
 import ecom_rag
-from ecom_rag import prod_inference, user_inference
+import config
+import catalog
+import chat_jobs
+import metrics
+import sessions
+import tool_calls
+from ecom_rag import prod_inference_stream, user_inference_stream
+
+logging.basicConfig(level=config.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 # Initialize the Dash app
 app = dash.Dash(__name__, suppress_callback_exceptions=True)
@@ -12,16 +22,22 @@ app = dash.Dash(__name__, suppress_callback_exceptions=True)
 # Define the layout for the home page
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
+    # Id of the chat answer being streamed, and the timer that polls it
+    dcc.Store(id='chat-job'),
+    # Key of this tab's conversations in the server-side session store
+    dcc.Store(id='chat-session', storage_type='session'),
+    dcc.Interval(id='chat-poll', interval=200, disabled=True),
     html.Div(id='page-content')
 ])
 
-# Sample list of links with images
-f = pd.read_json("assets/products.json")
-product_name_list = list(f["product_name"])
-links = [{'label': pro, 'href': '/' + pro.replace(" ", "_"), 'img_src': f'assets/{pro.replace(" ", "_")}.jpg'} for pro in product_name_list]
+# Sample list of links with images, built from the live catalog so reloads show up
+def get_product_links():
+    product_name_list = [record["product_name"] for record in catalog.store.snapshot.product_records]
+    return [{'label': pro, 'href': '/' + catalog.slugify(pro), 'img_src': f'assets/{catalog.slugify(pro)}.jpg'} for pro in product_name_list]
 
 
 def get_product_rack_layout():
+    links = get_product_links()
     # Create rows of 4 items each
     rows = []
     for i in range(0, len(links), 4):
@@ -79,112 +95,114 @@ def get_product_rack_layout():
     )
 
 # Define the layout for the home page
-home_layout = html.Div([
+def get_home_layout():
+    return html.Div([
     
-    html.Div(
-        [
-            html.H1(
-                "Fractured Peaks",
-                style={
-                    'fontSize': '2.5em',           # Larger font size for emphasis
-                    'color': '#343A40',           # Dark gray text color
-                    'margin': '0',                # Remove default margins
-                    'fontFamily': 'Arial, sans-serif', # Clean, modern font
-                    'fontWeight': 'bold' ,         # Bold font weight
-                    'borderRadius': '8px',
-                }
-            ),
-            html.A(
-                html.Div(
-                    ' 👤 ',  # User icon
+        html.Div(
+            [
+                html.H1(
+                    "Fractured Peaks",
                     style={
-                        'width': '40px',
-                        'height': '40px',
-                        'display': 'flex',
-                        'alignItems': 'center',
-                        'justifyContent': 'center',
-                        'borderRadius': '50%',
-                        'backgroundColor': '#007BFF',  # Blue background
-                        'color': '#FFFFFF',            # White text
-                        'textDecoration': 'none',
-                        'fontSize': '20px',            # Slightly larger icon
-                        'fontWeight': 'bold',
-                        'boxShadow': '0 4px 6px rgba(0, 0, 0, 0.2)'  # More pronounced shadow for depth
+                        'fontSize': '2.5em',           # Larger font size for emphasis
+                        'color': '#343A40',           # Dark gray text color
+                        'margin': '0',                # Remove default margins
+                        'fontFamily': 'Arial, sans-serif', # Clean, modern font
+                        'fontWeight': 'bold' ,         # Bold font weight
+                        'borderRadius': '8px',
                     }
                 ),
-                href='/user',  # Replace with the actual page URL
-                style={
-                    'marginLeft': '10px'           # Margin to the left of the button
-                }
-            )
-        ],
-        style={
-            'display': 'flex',
-            'alignItems': 'center',
-            'justifyContent': 'space-between',
-            'padding': '15px 20px',           # Increased padding for a spacious look
-            'backgroundColor': '#87CEEB',    # Light background color for the header
-            'borderBottom': '2px solid #DEE2E6', # Slightly thicker border for separation
-            'boxShadow': '0 2px 5px rgba(0, 0, 0, 0.1)', # Light shadow for a subtle lift effect
-            'fontFamily': 'Arial, sans-serif',  # Consistent font family
-            'borderRadius': '8px'
-        }
-    ),
+                html.A(
+                    html.Div(
+                        ' 👤 ',  # User icon
+                        style={
+                            'width': '40px',
+                            'height': '40px',
+                            'display': 'flex',
+                            'alignItems': 'center',
+                            'justifyContent': 'center',
+                            'borderRadius': '50%',
+                            'backgroundColor': '#007BFF',  # Blue background
+                            'color': '#FFFFFF',            # White text
+                            'textDecoration': 'none',
+                            'fontSize': '20px',            # Slightly larger icon
+                            'fontWeight': 'bold',
+                            'boxShadow': '0 4px 6px rgba(0, 0, 0, 0.2)'  # More pronounced shadow for depth
+                        }
+                    ),
+                    href='/user',  # Replace with the actual page URL
+                    style={
+                        'marginLeft': '10px'           # Margin to the left of the button
+                    }
+                )
+            ],
+            style={
+                'display': 'flex',
+                'alignItems': 'center',
+                'justifyContent': 'space-between',
+                'padding': '15px 20px',           # Increased padding for a spacious look
+                'backgroundColor': '#87CEEB',    # Light background color for the header
+                'borderBottom': '2px solid #DEE2E6', # Slightly thicker border for separation
+                'boxShadow': '0 2px 5px rgba(0, 0, 0, 0.1)', # Light shadow for a subtle lift effect
+                'fontFamily': 'Arial, sans-serif',  # Consistent font family
+                'borderRadius': '8px'
+            }
+        ),
 
-    html.Hr(),
-    html.Div(
-        [
-            get_product_rack_layout(),
+        html.Hr(),
+        html.Div(
+            [
+                get_product_rack_layout(),
 
-            html.Div(
-                [
-                    html.Div([
-                        html.H2("Chat Support", className='chat-support-header'),
-                    ], style={'backgroundColor': '#C3E7F5', 'padding' : "3px", 'borderRadius': '8px','boxShadow': '0 2px 4px rgba(0, 0, 0, 0.2)' }),
+                html.Div(
+                    [
+                        html.Div([
+                            html.H2("Chat Support", className='chat-support-header'),
+                        ], style={'backgroundColor': '#C3E7F5', 'padding' : "3px", 'borderRadius': '8px','boxShadow': '0 2px 4px rgba(0, 0, 0, 0.2)' }),
 
-                    html.Hr(),
+                        html.Hr(),
 
-                    # User input field
-                    dcc.Input(id='user-input', type='text', value='', className='chat-input'),
+                        # User input field
+                        dcc.Input(id='user-input', type='text', value='', className='chat-input'),
                     
-                    # Submit button
-                    html.Button(
-                        'Submit',
-                        id='submit-button',
-                        n_clicks=0,
-                        className='chat-submit-button'
-                    ),
+                        # Submit button
+                        html.Button(
+                            'Submit',
+                            id='submit-button',
+                            n_clicks=0,
+                            className='chat-submit-button'
+                        ),
                     
-                    # Output area for chat history
-                    html.Div(id='chat-history', className='chat-box')
-                ],
-                style={
-                    'flex': '3',
-                    'backgroundColor': '#f9f9f9',
-                    'padding': '20px',
-                    'borderRadius': '10px',
-                    'boxShadow': '0 8px 16px rgba(0, 0, 0, 0.1)',
-                    'display': 'flex',
-                    'flexDirection': 'column',
-                    'alignItems': 'center'
-                }
-            )
-        ], style={'display': 'flex', 'height': '100%'} 
-    ),
-])
+                        # Output area for chat history
+                        html.Div([html.Div(id='chat-turns'), html.Div(id='chat-pending')],
+                                 id='chat-history', className='chat-box')
+                    ],
+                    style={
+                        'flex': '3',
+                        'backgroundColor': '#f9f9f9',
+                        'padding': '20px',
+                        'borderRadius': '10px',
+                        'boxShadow': '0 8px 16px rgba(0, 0, 0, 0.1)',
+                        'display': 'flex',
+                        'flexDirection': 'column',
+                        'alignItems': 'center'
+                    }
+                )
+            ], style={'display': 'flex', 'height': '100%'} 
+        ),
+    ])
 
 def get_product_page(pathname):
     img_path = "/assets/" + str(pathname) + ".jpg"
 
-    f = pd.read_json("assets/products.json")
-    f.set_index('product_name', inplace=True, drop=True)
-    product_name = pathname.replace("_", " ")
-    description = str(f.loc[product_name, "description"])
-    warranty = str(f.loc[product_name, "warranty"])
-    inventory = str(f.loc[product_name, "inventory"])
-    refundable = str(f.loc[product_name, "refundable"])
-    reviews = str(f.loc[product_name, "reviews"])
-    price = str(f.loc[product_name, "price"])
+    product = catalog.store.snapshot.product(pathname)
+    if product is None:
+        return get_not_found_page(pathname)
+    description = str(product["description"])
+    warranty = str(product["warranty"])
+    inventory = str(product["inventory"])
+    refundable = str(product["refundable"])
+    reviews = str(product["reviews"])
+    price = str(product["price"])
     # price = ''.join([char for char in price if char.isdigit() or char == "."])
     # price = price.split('.')[0]
 
@@ -265,7 +283,7 @@ def get_product_page(pathname):
                 ),
 
                 # Output area for chat history
-                html.Div(id='chat-history', style={
+                html.Div([html.Div(id='chat-turns'), html.Div(id='chat-pending')], id='chat-history', style={
                     'width': '95%',
                     'textAlign': 'left',
                     'marginTop': '20px',
@@ -303,14 +321,14 @@ def get_product_page(pathname):
     ])
     return page_layout
 
-def get_user_order():
-    # Load data
-    f = pd.read_json("assets/user.json")
-    f.set_index('product_name', inplace=True)
+def get_not_found_page(pathname):
+    return html.Div([
+        html.H1(f"{pathname.replace('_', ' ')} was not found", style={'padding': '15px 20px', 'backgroundColor': '#87CEEB', 'borderRadius': '8px', 'fontFamily': 'Arial, sans-serif'}),
+        dcc.Link('Back to Home', href='/')
+    ])
 
-    f.drop_duplicates(inplace=True)
-    # Debugging: Print DataFrame to verify content
-    # print(f)
+def get_user_order():
+    orders = catalog.store.snapshot.order_records
 
     # Define custom CSS styles
     table_style = {
@@ -344,18 +362,17 @@ def get_user_order():
 
     # Create table rows
     table_rows = []
-    for i, item in enumerate(f.index):
-        # Debugging: Print each row to verify content
-        print(f.loc[item])
+    for i, order in enumerate(orders):
+        logger.debug("Order row: %s", order)
 
         row_style = row_even_style if i % 2 == 0 else {}
         row = html.Tr([
-            html.Td(item, style=cell_style),
-            html.Td(f.loc[item, 'price'], style=cell_style),
-            html.Td(f.loc[item, 'delivery_date'], style=cell_style),
-            html.Td(f.loc[item, 'order_status'], style=cell_style),
-            html.Td(f.loc[item, 'location'], style=cell_style),
-            html.Td(f.loc[item, 'refundable'], style=cell_style),
+            html.Td(order['product_name'], style=cell_style),
+            html.Td(order['price'], style=cell_style),
+            html.Td(order['delivery_date'], style=cell_style),
+            html.Td(order['order_status'], style=cell_style),
+            html.Td(order['location'], style=cell_style),
+            html.Td(order['refundable'], style=cell_style),
         ], style=row_style)
         table_rows.append(row)
 
@@ -439,7 +456,7 @@ def get_user_page():
                         'transition': 'background-color 0.3s ease'
                     }
                 ),
-                html.Div(id='chat-history', style={
+                html.Div([html.Div(id='chat-turns'), html.Div(id='chat-pending')], id='chat-history', style={
                     'width': '95%',
                     'textAlign': 'left',
                     'marginTop': '20px',
@@ -456,43 +473,104 @@ def get_user_page():
 
     return page_layout
 
+def answer_stream(url, user_input, usage=None, conversation=None):
+    if "user" == url:
+        response = ""
+        for chunk in user_inference_stream(user_input,top_k=20,temperature=0.2,top_p=1.0,max_new_tokens=256,usage=usage,
+                                           conversation=conversation):
+            response += chunk
+            yield chunk
+        # Order actions the answer asked for, run against the order store
+        for call in tool_calls.parse(response):
+            yield f"({tool_calls.run(call, config.default_user_id, user_input)})"
+    else:
+        add_context = None
+        if url is not None:
+            add_context = url.replace('_',' ')
+        yield from prod_inference_stream(user_input,top_k=50,temperature=0.3,top_p=1.0,max_new_tokens=256,additional_context=add_context,usage=usage,
+                                         conversation=conversation)
+
+def render_turns(page, conversation):
+    # Finished turns come from the session store, not from the browser
+    if conversation is None or not len(conversation):
+        return []
+    tokenizer = ecom_rag.bots["user" if page == "user" else "prod"][0].get()[1]
+    return [
+        html.Div([
+            html.P(f"You: {question}", style={'margin': '5px 0', 'fontWeight': 'bold'}),
+            html.P(f"Bot: {answer}", style={'margin': '5px 0'})
+        ], style={'padding': '5px', 'borderBottom': '1px solid #ddd'})
+        for question, answer in conversation.messages(tokenizer)
+    ]
+
+def render_chat_message(job):
+    children = [
+        html.P(f"You: {job.question}", style={'margin': '5px 0', 'fontWeight': 'bold'}),
+        html.P(f"Bot: {job.text.strip() or '...'}", style={'margin': '5px 0'})
+    ]
+    if job.error is not None:
+        children.append(html.P("(Something went wrong, please try again)", style={'margin': '5px 0', 'color': '#B00020'}))
+    if job.done and job.time_to_first_token() is not None:
+        children.append(html.P(
+            f"first token {job.time_to_first_token() * 1000:.0f} ms, total {job.total_latency() * 1000:.0f} ms, "
+            f"{job.usage.get('generated_tokens', 0)} tokens",
+            style={'margin': '5px 0', 'fontSize': '12px', 'color': '#888'}
+        ))
+    return html.Div(children, style={'padding': '5px', 'borderBottom': '1px solid #ddd'})
+
+def render_busy_message(user_input):
+    return html.Div([
+        html.P(f"You: {user_input}", style={'margin': '5px 0', 'fontWeight': 'bold'}),
+        html.P("Bot: I'm answering a lot of questions right now, please try again in a moment.",
+               style={'margin': '5px 0', 'color': '#B00020'})
+    ], style={'padding': '5px', 'borderBottom': '1px solid #ddd'})
+
 @app.callback(
-    Output('chat-history', 'children'),
-    [Input('url', 'pathname')],
-    [Input('submit-button', 'n_clicks')],
+    [Output('chat-turns', 'children'),
+     Output('chat-pending', 'children'),
+     Output('chat-job', 'data'),
+     Output('chat-poll', 'disabled'),
+     Output('chat-session', 'data')],
+    [Input('url', 'pathname'),
+     Input('submit-button', 'n_clicks'),
+     Input('chat-poll', 'n_intervals')],
     [State('user-input', 'value'),
-     State('chat-history', 'children')]
+     State('chat-job', 'data'),
+     State('chat-session', 'data')]
 )
-def update_chat_history(url ,n_clicks, user_input, current_chat):
-    if n_clicks > 0:
+def update_chat_history(url ,n_clicks, n_intervals, user_input, job_id, session_id):
+    # Only the answer being generated is re-rendered while polling; finished
+    # turns are rendered from the session store when a question is sent or the page opens
+    session_id = session_id or sessions.new_session_id()
+    page = str(url).lstrip('/')
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+
+    if 'chat-poll.n_intervals' in triggered:
+        job = chat_jobs.get_job(job_id)
+        if job is None:
+            return dash.no_update, dash.no_update, None, True, session_id
+        if job.done:
+            chat_jobs.finish_job(job_id)
+            return dash.no_update, render_chat_message(job), None, True, session_id
+        return dash.no_update, render_chat_message(job), job_id, False, session_id
+
+    if 'submit-button.n_clicks' in triggered and n_clicks > 0:
         if user_input:
-            print("received user input on url:", url)
-            url = str(url).lstrip('/')
-            if "user" == url:
-                response = user_inference(user_input,top_k=20,temperature=0.2,top_p=1.0,max_new_tokens=256)
-                if 'initiate_refund' in response:
-                    response += "(Product queued for refund)"
-                if 'change_location' in response:
-                    response += "(Product shipping location has been changed)"
-            else:
-                add_context = None
-                if url is not None:
-                    add_context = url.replace('_',' ')
-                response = prod_inference(user_input,top_k=50,temperature=0.3,top_p=1.0,max_new_tokens=256,additional_context=add_context)
-            new_message = html.Div(
-                [
-                    html.P(f"You: {user_input}", style={'margin': '5px 0', 'fontWeight': 'bold'}),
-                    html.P(f"Bot: {response}", style={'margin': '5px 0'})
-                ],
-                style={'padding': '5px', 'borderBottom': '1px solid #ddd'}
-            )
-
-            if current_chat is None:
-                current_chat = []
-
-            return current_chat + [new_message]
-    
-    return []
+            if job_id is not None and chat_jobs.get_job(job_id) is not None:
+                # One answer at a time per chat box
+                return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+            logger.debug("received user input on url: %s", url)
+            conversation = sessions.store.conversation(session_id, page)
+            try:
+                job = chat_jobs.start_job(user_input, answer_stream, page, user_input, conversation=conversation)
+            except chat_jobs.ChatQueueFull as e:
+                logger.warning("Chat queue full: %s", e)
+                return render_turns(page, conversation), render_busy_message(user_input), None, True, session_id
+            return render_turns(page, conversation), render_chat_message(job), job.id, False, session_id
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, session_id
+
+    # Page opened: show what this tab already discussed here
+    return render_turns(page, sessions.store.conversation(session_id, page, create=False)), None, None, True, session_id
 
 @app.callback(
     Output('page-content', 'children'),
@@ -501,11 +579,61 @@ def update_chat_history(url ,n_clicks, user_input, current_chat):
 def update_page(pathname):
     pathname = pathname.lstrip("/").rstrip("/")
     if pathname == "":
-        return home_layout
+        return get_home_layout()
     elif pathname == "user":
         return get_user_page()
     else:
         return get_product_page(pathname)
 
+@app.server.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    # Re-read products.json/user.json without a restart (the file watcher does
+    # the same on its own). Needs ECOM_ADMIN_TOKEN if set, else a local caller.
+    if config.admin_token:
+        if request.headers.get('X-Admin-Token') != config.admin_token:
+            return jsonify({'error': 'forbidden'}), 403
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({'reencoded_rows': ecom_rag.reload_catalog()})
+
+@app.server.route('/chat/jobs', methods=['POST'])
+def create_chat_job():
+    # {"question": ..., "page": "user" or a product page name, "session_id": optional}
+    # -> 202 {"job_id", "session_id"}; questions with the same session_id and
+    # page continue one conversation
+    payload = request.get_json(silent=True) or {}
+    question = payload.get('question')
+    if not question:
+        return jsonify({'error': 'question is required'}), 400
+    page = str(payload.get('page', '')).strip('/')
+    session_id = str(payload.get('session_id') or sessions.new_session_id())
+    conversation = sessions.store.conversation(session_id, page)
+    try:
+        job = chat_jobs.start_job(question, answer_stream, page, question, conversation=conversation)
+    except chat_jobs.ChatQueueFull:
+        response = jsonify({'error': 'busy', 'queued': chat_jobs.queue_depth()})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return jsonify({'job_id': job.id, 'session_id': session_id}), 202
+
+@app.server.route('/chat/jobs/<job_id>', methods=['GET'])
+def get_chat_job(job_id):
+    # Long poll: ?since=<chars already read>&wait=<seconds> returns as soon as
+    # there is new text, the answer is done or wait runs out
+    job = chat_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'not found'}), 404
+    since = request.args.get('since', 0, type=int)
+    wait = min(request.args.get('wait', 0, type=float), 30)
+    text, done = job.wait(since, wait)
+    return jsonify({'text': text[since:], 'length': len(text), 'done': done, 'error': job.error,
+                    'queued': job.running_at is None,
+                    'generated_tokens': job.usage.get('generated_tokens') if done else None})
+
+@app.server.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Prometheus text format: stage latencies, token counts, cache hits, queue depths
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run_server(debug=False)
@@ -0,0 +1,72 @@
+import argparse
+import time
+import numpy as np
+
+import retrieval
+import embedding_store
+
+# Recall@k and latency of the IVF index against exact search.
+#   python -m benchmarks.ann_recall --rows 200000 --lists 512
+#   python -m benchmarks.ann_recall --table products   (use the built embeddings)
+
+def synthetic_embeddings(rows, dim, clusters, seed):
+    # Clustered unit vectors, closer to sentence embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    data = centers[rng.integers(clusters, size=rows)] + 0.5 * rng.normal(size=(rows, dim))
+    return retrieval.normalize_rows(data)
+
+def timed_search(index, queries, k, **kwargs):
+    start = time.perf_counter()
+    for query in queries:
+        result = index.search(query, k, **kwargs)
+    return (time.perf_counter() - start) / len(queries) * 1000, result
+
+def recall_at_k(approx, exact):
+    hits = [len(set(a) & set(e)) for a, e in zip(approx, exact)]
+    return sum(hits) / exact.size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", default=None, help="embedding_store table name instead of synthetic data")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--lists", type=int, default=0)
+    parser.add_argument("--probes", default="1,2,4,8,16,32,64")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.table:
+        data, _ = embedding_store.load_embeddings(args.table)
+        if data is None:
+            raise SystemExit(f"No embeddings built for table {args.table}")
+    else:
+        data = synthetic_embeddings(args.rows, args.dim, args.clusters, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    # Perturbed rows as queries, so each query has a real neighbourhood
+    queries = retrieval.normalize_rows(data[rng.integers(len(data), size=args.queries)]
+                                       + 0.1 * rng.normal(size=(args.queries, data.shape[1])))
+
+    exact = retrieval.DenseIndex(data, normalized=True)
+    exact_ms, _ = timed_search(exact, queries, args.k)
+    exact_ids, _ = exact.search(queries, args.k)
+
+    start = time.perf_counter()
+    ivf = retrieval.IVFIndex(data, n_lists=args.lists, normalized=True, seed=args.seed)
+    build_s = time.perf_counter() - start
+
+    print(f"rows={len(data)} dim={data.shape[1]} k={args.k} lists={ivf.n_lists} build={build_s:.1f}s")
+    print(f"{'backend':<16}{'recall@k':>10}{'ms/query':>10}{'speedup':>9}")
+    print(f"{'exact':<16}{1.0:>10.3f}{exact_ms:>10.3f}{1.0:>9.1f}")
+    for n_probe in (int(p) for p in args.probes.split(",")):
+        if n_probe > ivf.n_lists:
+            break
+        ms, _ = timed_search(ivf, queries, args.k, n_probe=n_probe)
+        approx_ids, _ = ivf.search(queries, args.k, n_probe=n_probe)
+        print(f"{'ivf probe=' + str(n_probe):<16}{recall_at_k(approx_ids, exact_ids):>10.3f}{ms:>10.3f}{exact_ms / ms:>9.1f}")
+
+if __name__ == "__main__":
+    main()
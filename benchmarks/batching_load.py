@@ -0,0 +1,79 @@
+import argparse
+import time
+import threading
+
+import numpy as np
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from dialogue import get_dialogue_template
+from generation_server import BatchedGenerator
+from benchmarks.standin_models import ensure_standin_model
+
+# CPU load test for BatchedGenerator: N client threads fire chat prompts at
+# once and we compare throughput/latency across max batch sizes.
+#   python -m benchmarks.batching_load --clients 16 --batch-sizes 1,4,8,16
+#   python -m benchmarks.batching_load --model ecom_bot_prod
+
+def sample_prompts(n):
+    template = get_dialogue_template()
+    questions = ["What is the price?", "Is it refundable?", "How many are in stock?", "What is the warranty?"]
+    prompts = []
+    for i in range(n):
+        template.message = {"product_name": f"Product {i}", "price": f"${10 + i}.99", "warranty": "1 year",
+                            "description": "A sample product used for load testing. " * (1 + i % 3),
+                            "user_question": questions[i % len(questions)]}
+        prompts.append(template.get_inference_prompt())
+    return prompts
+
+def run_load(generator, prompts, clients, requests_per_client, generate_kwargs):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(offset):
+        for i in range(requests_per_client):
+            start = time.perf_counter()
+            generator.generate(prompts[(offset + i) % len(prompts)], **generate_kwargs)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.array(latencies)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="standin_bot", help="model dir, a stand-in is built there if missing")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=4, help="requests per client")
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.model == "standin_bot":
+        ensure_standin_model(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model).eval()
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    prompts = sample_prompts(args.clients)
+    # Fixed length, so every configuration does the same amount of decoding
+    generate_kwargs = {"max_new_tokens": args.max_new_tokens, "min_new_tokens": args.max_new_tokens,
+                       "do_sample": True, "top_k": 50, "temperature": 0.3}
+
+    print(f"{'max_batch':>9}{'req/s':>9}{'tok/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'avg batch':>10}")
+    for max_batch_size in (int(b) for b in args.batch_sizes.split(",")):
+        generator = BatchedGenerator(model, tokenizer, device="cpu", max_batch_size=max_batch_size,
+                                     max_wait_ms=args.max_wait_ms)
+        generator.generate(prompts[0], **generate_kwargs)  # warm-up
+        generator.batches_run = generator.requests_run = 0
+        elapsed, latencies = run_load(generator, prompts, args.clients, args.requests, generate_kwargs)
+        total = len(latencies)
+        print(f"{max_batch_size:>9}{total / elapsed:>9.1f}{total * args.max_new_tokens / elapsed:>9.0f}"
+              f"{np.percentile(latencies, 50) * 1000:>9.0f}{np.percentile(latencies, 95) * 1000:>9.0f}"
+              f"{generator.requests_run / generator.batches_run:>10.1f}")
+
+if __name__ == "__main__":
+    main()
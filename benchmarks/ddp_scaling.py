@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import tempfile
+
+import torch
+
+import train
+from benchmarks.standin_models import ensure_standin_model
+
+# Data-parallel scaling of train.finetune on the gloo backend: the same run
+# with 1, 2, 4, ... CPU processes at a fixed per-process batch size.
+# Efficiency is tok/s(N) / (N * tok/s(1)).
+#   python -m benchmarks.ddp_scaling --procs 1,2,4
+#   python -m benchmarks.ddp_scaling --model gpt2 --data train.jsonl --seq-length 512
+
+def sample_records(path, n):
+    with open("assets/products.json", "r", encoding="utf-8") as f:
+        products = json.load(f)
+    questions = ["What is the price?", "Is it refundable?", "How many are in stock?", "What is the warranty?"]
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            record = dict(products[i % len(products)])
+            record["user_question"] = questions[i % len(questions)]
+            record["support_answer"] = f"The {record['product_name']} costs {record['price']}."
+            f.write(json.dumps(record) + "\n")
+
+def _worker(rank, world_size, argv, port, result_path):
+    args = train.parse_args(argv)
+    train.init_distributed(rank, world_size, "gloo", port)
+    try:
+        stats = train.run(args, rank, world_size)
+    finally:
+        torch.distributed.destroy_process_group()
+    if rank == 0:
+        with open(result_path, "w", encoding="utf-8") as f:
+            json.dump(stats, f)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="standin_bot", help="model dir, a stand-in is built there if missing")
+    parser.add_argument("--data", help=".json/.jsonl training records, default: generated from the catalog")
+    parser.add_argument("--procs", default="1,2,4")
+    parser.add_argument("--batch-size", type=int, default=4, help="per process")
+    parser.add_argument("--seq-length", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.model == "standin_bot":
+        ensure_standin_model(args.model)
+    with tempfile.TemporaryDirectory() as tmp:
+        data = args.data
+        if data is None:
+            data = os.path.join(tmp, "train.jsonl")
+            sample_records(data, 2000)
+        print(f"{'procs':>6}{'tok/s':>10}{'speedup':>9}{'efficiency':>11}")
+        base = None
+        for procs in (int(p) for p in args.procs.split(",")):
+            result_path = os.path.join(tmp, f"stats-{procs}.json")
+            argv = [data, "--model", args.model, "--output", os.path.join(tmp, "out"), "--device", "cpu",
+                    "--epochs", "1000", "--max-steps", str(args.steps), "--batch-size", str(args.batch_size),
+                    "--seq-length", str(args.seq_length), "--warmup-steps", "1", "--checkpoint-every", "0",
+                    "--checkpoint-dir", os.path.join(tmp, f"checkpoint-{procs}")]
+            torch.multiprocessing.spawn(_worker, args=(procs, argv, train.free_port(), result_path), nprocs=procs)
+            with open(result_path, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+            throughput = stats["tokens"] / stats["seconds"]
+            base = base or throughput
+            print(f"{procs:>6}{throughput:>10.0f}{throughput / base:>9.2f}{throughput / (base * procs):>11.0%}")
+
+if __name__ == "__main__":
+    main()
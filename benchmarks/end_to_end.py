@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import threading
+import subprocess
+
+import numpy as np
+import torch
+
+from dialogue import get_dialogue_template
+from benchmarks.standin_models import ensure_standin_model
+
+# Where a chat answer spends its time: replays questions through retrieval
+# (data_rag.search), prompt building (DialogueTemplate.get_inference_prompt),
+# tokenization, generate and decoding one stage at a time, then the whole
+# ecom_rag.run_inference path from 1, 4, 8, ... concurrent clients (the
+# "no model" column is the share answered by the rule engine or a cache).
+# Results go to a JSON file named after the commit; --compare prints the
+# change against an earlier one.
+#   python -m benchmarks.end_to_end
+#   python -m benchmarks.end_to_end --model ecom_bot_prod --questions my_questions.json
+#   python -m benchmarks.end_to_end --compare benchmark_results/end_to_end-4a99c32.json
+# Without --model the chat model is a random stand-in, so generate timings
+# reflect shapes and lengths, not answer quality.
+
+# Question shapes customers ask on product pages (cf. the prompt list in ecom_rag)
+question_templates = [
+    "What is the price of the {name}?",
+    "How much does the {name} cost?",
+    "Is the {name} refundable?",
+    "What warranty does the {name} come with?",
+    "How many {name} are in inventory?",
+    "What are the dimensions of the {name}?",
+    "What do reviews say about the {name}?",
+    "Is the {name} good for a small apartment?",
+]
+
+stages = ["retrieval", "prompt", "tokenize", "generate", "decode"]
+
+def sample_questions(path, n):
+    # path holds either a list of question strings or catalog-style records
+    # (assets/test.json); records without a user_question get templated ones
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    questions = []
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            questions.append(item)
+        elif item.get("user_question"):
+            questions.append(item["user_question"])
+        else:
+            template = question_templates[i % len(question_templates)]
+            questions.append(template.format(name=item["product_name"]))
+    return [questions[i % len(questions)] for i in range(n)]
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {"p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)), "mean_ms": float(values.mean())}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure_stages(ecom_rag, questions, generate_kwargs):
+    # One question at a time, so every stage is timed without contention
+    model, tokenizer, device, _ = ecom_rag.prod_model.get()
+    timings = {stage: [] for stage in stages}
+    tokens = 0
+    for question in questions:
+        start = time.perf_counter()
+        row = ecom_rag.erag.search(question).copy()
+        retrieved = time.perf_counter()
+        row["user_question"] = question
+        template = get_dialogue_template()
+        template.message = row
+        prompt = template.get_inference_prompt()
+        prompted = time.perf_counter()
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(device)
+        tokenized = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), **generate_kwargs)
+        generated = time.perf_counter()
+        new_ids = output[0, input_ids.shape[1]:].tolist()
+        ecom_rag.decode_response(tokenizer, new_ids)
+        decoded = time.perf_counter()
+        tokens += len(new_ids)
+        for stage, (begin, end) in zip(stages, [(start, retrieved), (retrieved, prompted), (prompted, tokenized),
+                                                (tokenized, generated), (generated, decoded)]):
+            timings[stage].append(end - begin)
+    result = {stage: percentiles(values) for stage, values in timings.items()}
+    result["total"] = percentiles(np.sum([timings[stage] for stage in stages], axis=0))
+    return result, tokens
+
+def measure_concurrency(ecom_rag, questions, clients, inference_kwargs):
+    latencies = []
+    usages = []
+    lock = threading.Lock()
+
+    def client(offset):
+        for question in questions[offset::clients]:
+            usage = {}
+            start = time.perf_counter()
+            ecom_rag.prod_inference(question, usage=usage, **inference_kwargs)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                usages.append(usage)
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    tokens = sum(usage.get("generated_tokens", 0) for usage in usages)
+    sources = {}
+    for usage in usages:
+        sources[usage.get("source")] = sources.get(usage.get("source"), 0) + 1
+    result = {"clients": clients, "requests": len(latencies), "requests_per_s": len(latencies) / elapsed,
+              "tokens_per_s": tokens / elapsed, "sources": sources}
+    result.update(percentiles(latencies))
+    return result
+
+def print_comparison(results, baseline):
+    print(f"\nagainst {baseline['commit']} ({baseline['created']}):")
+    print(f"{'stage':>12}{'p50 was':>10}{'p50 now':>10}{'p95 was':>10}{'p95 now':>10}{'change':>9}")
+    for stage, now in results["stages"].items():
+        was = baseline["stages"].get(stage)
+        if was is None:
+            continue
+        print(f"{stage:>12}{was['p50_ms']:>10.1f}{now['p50_ms']:>10.1f}{was['p95_ms']:>10.1f}{now['p95_ms']:>10.1f}"
+              f"{now['p50_ms'] / was['p50_ms'] - 1:>9.0%}")
+    previous = {level["clients"]: level for level in baseline["concurrency"]}
+    for level in results["concurrency"]:
+        was = previous.get(level["clients"])
+        if was is not None:
+            print(f"{level['clients']:>3} clients: {was['requests_per_s']:.2f} -> {level['requests_per_s']:.2f} req/s, "
+                  f"p95 {was['p95_ms']:.0f} -> {level['p95_ms']:.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="standin_bot", help="product bot dir, a stand-in is built there if missing")
+    parser.add_argument("--questions", default="assets/test.json", help="JSON list of questions or product records")
+    parser.add_argument("--requests", type=int, default=64, help="questions per measurement")
+    parser.add_argument("--clients", default="1,4,8")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--cache", action="store_true", help="keep the retrieval and response caches on")
+    parser.add_argument("--no-rules", action="store_true", help="generate every answer, no templated replies")
+    parser.add_argument("--out", default=None, help="default: benchmark_results/end_to_end-<commit>.json")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    if args.model == "standin_bot":
+        ensure_standin_model(args.model)
+    # ecom_rag loads the catalog and embeddings on import and reads the model
+    # path from config, so it is imported only once the model is chosen
+    os.environ["ECOM_PROD_MODEL"] = args.model
+    import ecom_rag
+
+    if not args.cache:
+        ecom_rag.retrieval_cache.max_entries = 0
+        ecom_rag.response_cache.max_entries = 0
+    if args.no_rules:
+        ecom_rag.config.rule_answers = False
+    questions = sample_questions(args.questions, args.requests)
+    _, tokenizer, _, _ = ecom_rag.prod_model.get()
+    # Same sampling settings the product page uses (app.answer_stream)
+    inference_kwargs = {"max_new_tokens": args.max_new_tokens, "temperature": 0.3, "top_k": 50, "top_p": 1.0}
+    generate_kwargs = dict(inference_kwargs, do_sample=True, pad_token_id=tokenizer.pad_token_id,
+                           eos_token_id=ecom_rag.stop_token_ids(tokenizer))
+
+    measure_stages(ecom_rag, questions[:2], generate_kwargs)  # warm-up
+    stage_results, tokens = measure_stages(ecom_rag, questions, generate_kwargs)
+    concurrency = [measure_concurrency(ecom_rag, questions, int(clients), inference_kwargs)
+                   for clients in args.clients.split(",")]
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "settings": {"model": args.model, "questions": args.questions, "requests": args.requests,
+                     "max_new_tokens": args.max_new_tokens, "cache": args.cache,
+                     "rule_answers": ecom_rag.config.rule_answers,
+                     "embedding_model": ecom_rag.config.embedding_model_name,
+                     "index_backend": ecom_rag.config.index_backend, "device": str(ecom_rag.prod_model.get()[2]),
+                     "quantize": ecom_rag.config.model_quantize, "torch_threads": torch.get_num_threads()},
+        "generated_tokens_per_request": tokens / len(questions),
+        "stages": stage_results,
+        "concurrency": concurrency,
+    }
+
+    print(f"\n{'stage':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, result in stage_results.items():
+        print(f"{stage:>12}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+    print(f"\n{'clients':>8}{'req/s':>9}{'tok/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'no model':>10}")
+    for level in concurrency:
+        bypassed = level["requests"] - level["sources"].get("model", 0)
+        print(f"{level['clients']:>8}{level['requests_per_s']:>9.2f}{level['tokens_per_s']:>9.0f}"
+              f"{level['p50_ms']:>9.0f}{level['p95_ms']:>9.0f}{level['p99_ms']:>9.0f}"
+              f"{bypassed / max(level['requests'], 1):>10.0%}")
+
+    out = args.out or os.path.join("benchmark_results", f"end_to_end-{results['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {out}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
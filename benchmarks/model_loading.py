@@ -0,0 +1,86 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from model_loading import load_causal_lm
+from benchmarks.batching_load import sample_prompts
+from benchmarks.standin_models import ensure_standin_model
+
+# Startup time, memory and generation latency for each model loading mode.
+# Every mode runs in a fresh interpreter so peak RSS is not shared.
+#   python -m benchmarks.model_loading
+#   python -m benchmarks.model_loading --model ecom_bot_prod --modes cpu,cpu-int8,cuda
+
+modes = {
+    "cpu": ("cpu", "none"),
+    "cpu-int8": ("cpu", "int8"),
+    "cuda": ("cuda", "none"),
+}
+
+def rss_mb():
+    # Current resident set size, from /proc where available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(model_path, mode, max_new_tokens, runs):
+    device, quantize = modes[mode]
+    baseline = rss_mb()
+    start = time.perf_counter()
+    model, tokenizer, device = load_causal_lm(model_path, device, quantize)
+    load_seconds = time.perf_counter() - start
+    loaded_rss = rss_mb()
+
+    input_ids = tokenizer(sample_prompts(1)[0], return_tensors="pt").input_ids.to(device)
+    kwargs = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False,
+              "pad_token_id": tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id}
+    with torch.no_grad():
+        model.generate(input_ids, **kwargs)  # warm-up
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.generate(input_ids, **kwargs)
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+    return {"mode": mode, "device": device, "load_s": load_seconds, "load_rss_mb": loaded_rss - baseline,
+            "peak_rss_mb": peak_rss_mb(), "generate_ms": 1000 * sorted(latencies)[len(latencies) // 2],
+            "tok_s": max_new_tokens / sorted(latencies)[len(latencies) // 2]}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="standin_bot", help="model dir, a stand-in is built there if missing")
+    parser.add_argument("--modes", default="cpu,cpu-int8" + (",cuda" if torch.cuda.is_available() else ""))
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.model, args.child, args.max_new_tokens, args.runs)))
+        return
+
+    if args.model == "standin_bot":
+        ensure_standin_model(args.model)
+    print(f"{'mode':>9}{'device':>8}{'load s':>9}{'load MB':>9}{'peak MB':>9}{'gen ms':>9}{'tok/s':>8}")
+    for mode in args.modes.split(","):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.model_loading", "--model", args.model,
+                                 "--max-new-tokens", str(args.max_new_tokens), "--runs", str(args.runs),
+                                 "--child", mode], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{result['mode']:>9}{result['device']:>8}{result['load_s']:>9.2f}{result['load_rss_mb']:>9.0f}"
+              f"{result['peak_rss_mb']:>9.0f}{result['generate_ms']:>9.0f}{result['tok_s']:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import train
+import training_data
+from dialogue import get_dialogue_template
+from benchmarks.standin_models import build_standin_model
+
+# Latency and draft acceptance of speculative (assisted) decoding on CPU:
+# each prompt is answered by the bot alone and by the bot verifying a draft
+# model's proposals. Forward hooks count the model calls:
+#   accepted tokens = new tokens - bot forwards (each bot pass adds one of its own)
+#   acceptance rate = accepted tokens / draft forwards (one proposed token each)
+# Without --model/--draft a stand-in pair is built and briefly fine-tuned on
+# formulaic answers, so the numbers only show the mechanics.
+#   python -m benchmarks.speculative_decoding
+#   python -m benchmarks.speculative_decoding --model ecom_bot_prod --draft ecom_bot_prod_draft
+
+questions = ["What is the price?", "How much does it cost?", "Is it refundable?", "What is the warranty?"]
+
+def sample_records(n):
+    with open("assets/products.json", "r", encoding="utf-8") as f:
+        products = json.load(f)
+    records = []
+    for i in range(n):
+        product = products[i % len(products)]
+        question = questions[i % len(questions)]
+        if "refund" in question:
+            answer = f"Yes, the {product['product_name']} is refundable: {product['refundable']}."
+        elif "warranty" in question:
+            answer = f"The {product['product_name']} comes with a {product['warranty']}."
+        else:
+            answer = f"The {product['product_name']} costs {product['price']}."
+        records.append({"product_name": product["product_name"], "price": product["price"],
+                        "warranty": product["warranty"], "refundable": product["refundable"],
+                        "user_question": question, "support_answer": answer})
+    return records
+
+def build_standin_pair(directory, steps):
+    # Bot and draft share the stand-in tokenizer; both are fine-tuned on the
+    # same answers, the way a real draft would be trained next to the bot
+    target_path = os.path.join(directory, "target")
+    draft_path = os.path.join(directory, "draft")
+    if os.path.exists(os.path.join(draft_path, "config.json")):
+        return target_path, draft_path
+    os.makedirs(directory, exist_ok=True)
+    data_path = os.path.join(directory, "train.jsonl")
+    with open(data_path, "w", encoding="utf-8") as f:
+        for record in sample_records(2000):
+            f.write(json.dumps(record) + "\n")
+    for path, n_layer, n_embd, n_head in ((target_path, 4, 192, 4), (draft_path, 1, 96, 2)):
+        model, tokenizer = build_standin_model(path, n_layer=n_layer, n_embd=n_embd, n_head=n_head)
+        train_loader, _ = training_data.get_dataloaders(data_path, tokenizer, seq_length=256, batch_size=8,
+                                                        cache_dir=os.path.join(directory, "token_cache"))
+        train.finetune(model, tokenizer, train_loader, epochs=100, learning_rate=1e-3, warmup_steps=10,
+                       device="cpu", log_every=0, max_steps=steps)
+        model.save_pretrained(path)
+    return target_path, draft_path
+
+class ForwardCounter:
+    def __init__(self, model):
+        self.calls = 0
+        model.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        self.calls += 1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="bot model dir, default: fine-tuned stand-in")
+    parser.add_argument("--draft", help="draft model dir, must share the bot's tokenizer")
+    parser.add_argument("--standin-dir", default="standin_speculative")
+    parser.add_argument("--train-steps", type=int, default=150, help="fine-tuning steps for the stand-ins")
+    parser.add_argument("--prompts", type=int, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--sample", action="store_true", help="sample (temperature 0.3) instead of greedy")
+    args = parser.parse_args()
+
+    model_path, draft_path = args.model, args.draft
+    if model_path is None or draft_path is None:
+        model_path, draft_path = build_standin_pair(args.standin_dir, args.train_steps)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path).eval()
+    draft = AutoModelForCausalLM.from_pretrained(draft_path).eval()
+    model_calls, draft_calls = ForwardCounter(model), ForwardCounter(draft)
+
+    template = get_dialogue_template()
+    prompts = []
+    for record in sample_records(args.prompts * 7)[::7]:
+        template.message = record
+        prompts.append(template.get_inference_prompt())
+    end_id = tokenizer.convert_tokens_to_ids(template.end_token)
+    kwargs = {"max_new_tokens": args.max_new_tokens, "pad_token_id": tokenizer.pad_token_id, "eos_token_id": end_id}
+    kwargs.update({"do_sample": True, "temperature": 0.3, "top_k": 50} if args.sample else {"do_sample": False})
+
+    results = {}
+    for mode in ("bot", "speculative"):
+        extra = {"assistant_model": draft} if mode == "speculative" else {}
+        latencies, tokens = [], 0
+        model_calls.calls = draft_calls.calls = 0
+        with torch.no_grad():
+            model.generate(tokenizer(prompts[0], return_tensors="pt").input_ids, **kwargs, **extra)  # warm-up
+            model_calls.calls = draft_calls.calls = 0
+            for prompt in prompts:
+                input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+                start = time.perf_counter()
+                output = model.generate(input_ids, **kwargs, **extra)
+                latencies.append(time.perf_counter() - start)
+                tokens += output.shape[1] - input_ids.shape[1]
+        results[mode] = (np.array(latencies), tokens, model_calls.calls, draft_calls.calls)
+
+    base = np.median(results["bot"][0])
+    print(f"{'mode':>12}{'p50 ms':>9}{'tok/s':>8}{'speedup':>9}{'bot fwd/tok':>12}{'accepted':>10}")
+    for mode, (latencies, tokens, bot_forwards, draft_forwards) in results.items():
+        accepted = tokens - bot_forwards
+        acceptance = f"{accepted / draft_forwards:.0%}" if draft_forwards else "-"
+        print(f"{mode:>12}{np.median(latencies) * 1000:>9.0f}{tokens / latencies.sum():>8.0f}"
+              f"{base / np.median(latencies):>9.2f}{bot_forwards / max(tokens, 1):>12.2f}{acceptance:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+import json
+import argparse
+
+from dialogue import get_dialogue_template
+
+# Tiny randomly initialised GPT-2 with the same special tokens as ecom_bot_prod /
+# ecom_bot_user, saved in from_pretrained() layout. Output is gibberish, but
+# shapes, tokenization and the generate() path match the real bots, so it can
+# stand in for load tests and CPU runs without downloading anything.
+#   python -m benchmarks.standin_models --out standin_bot
+
+def _bytes_to_unicode():
+    # Same byte -> printable char table the GPT-2 byte-level BPE uses
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, (chr(c) for c in cs)))
+
+def build_standin_tokenizer(path):
+    from transformers import GPT2TokenizerFast
+
+    os.makedirs(path, exist_ok=True)
+    vocab = {char: i for i, char in enumerate(_bytes_to_unicode().values())}
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = GPT2TokenizerFast(os.path.join(path, "vocab.json"), os.path.join(path, "merges.txt"))
+    tokenizer.add_special_tokens({'additional_special_tokens': get_dialogue_template().get_special_tokens()})
+    tokenizer.add_special_tokens({'pad_token': '<|pad|>'})
+    return tokenizer
+
+def build_standin_model(path, n_layer=2, n_embd=64, n_head=2, seed=0):
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    tokenizer = build_standin_tokenizer(path)
+    model_config = GPT2Config(vocab_size=len(tokenizer), n_positions=1024, n_embd=n_embd, n_layer=n_layer, n_head=n_head,
+                              bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+    model = GPT2LMHeadModel(model_config)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return model, tokenizer
+
+def ensure_standin_model(path, **kwargs):
+    if not os.path.exists(os.path.join(path, "config.json")):
+        build_standin_model(path, **kwargs)
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="standin_bot")
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--embd", type=int, default=64)
+    parser.add_argument("--heads", type=int, default=2)
+    args = parser.parse_args()
+    build_standin_model(args.out, args.layers, args.embd, args.heads)
+    print(f"Saved stand-in model to {args.out}")
@@ -0,0 +1,43 @@
+import copy
+
+import config
+import catalog_io
+import orders
+
+# Products and orders are read once at startup and shared by app.py and
+# ecom_rag.py. Page rendering only touches the in-memory snapshot. Orders come
+# from orders.store, which keeps the users file and its journal of changes.
+
+def slugify(product_name):
+    # Same form as the /<Product_Name> links and the asset file names
+    return str(product_name).replace(" ", "_")
+
+class CatalogSnapshot:
+    def __init__(self, products, users):
+        self.products = products
+        self.users = users
+        self.product_records = products.to_dict('records')
+        self.by_slug = {slugify(record['product_name']): record for record in self.product_records}
+        self.order_records = users.drop_duplicates().to_dict('records')
+
+    def product(self, slug):
+        return self.by_slug.get(slug)
+
+    def with_users(self, users):
+        # Same products, new orders (after an order action)
+        snapshot = copy.copy(self)
+        snapshot.users = users
+        snapshot.order_records = users.drop_duplicates().to_dict('records')
+        return snapshot
+
+class CatalogStore:
+    def __init__(self, products_path, order_store):
+        self.products_path = products_path
+        self.order_store = order_store
+        self.snapshot = self.load()
+
+    def load(self):
+        self.order_store.reload()
+        return CatalogSnapshot(catalog_io.read_table(self.products_path), self.order_store.frame())
+
+store = CatalogStore(config.products_path, orders.store)
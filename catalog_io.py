@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import struct
+import tempfile
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# Catalog and training files can be
+#   .json              one JSON array of records (the original format)
+#   .jsonl / .ndjson   one JSON record per line
+#   .cols              columnar file written by write_columns
+# iter_records streams any of them one record at a time, so indexing and
+# training never need the whole file in memory. read_table builds the
+# DataFrame the app serves.
+#
+# .cols layout: b"ECOMCOL1", uint64 header length, JSON header, then one
+# 8-byte aligned buffer per column. int64/float64 columns are raw arrays;
+# str and json columns are rows+1 int64 offsets followed by a utf-8 blob
+# (json columns hold each value JSON encoded, for lists, nulls and mixed types).
+# The whole file is memory mapped, single columns are read without parsing rows.
+
+columns_magic = b"ECOMCOL1"
+_whitespace = re.compile(r"[\s,]*")
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".cols":
+        return "columns"
+    return "json"
+
+def _iter_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from None
+
+def _iter_json_array(path, chunk_size=1 << 16):
+    # Decodes the records of a top-level array as the file is read
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path}: expected a JSON array")
+        position = 1
+        eof = False
+        while True:
+            position = _whitespace.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise ValueError(f"{path}: truncated JSON array") from None
+                more = f.read(chunk_size)
+                eof = not more
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            position = end
+            yield record
+
+def iter_records(path):
+    kind = file_format(path)
+    if kind == "jsonl":
+        return _iter_jsonl(path)
+    if kind == "columns":
+        return ColumnTable(path).iter_records()
+    return _iter_json_array(path)
+
+def read_table(path):
+    if file_format(path) == "columns":
+        return ColumnTable(path).to_frame()
+    if file_format(path) == "jsonl":
+        return pd.DataFrame.from_records(iter_records(path))
+    return pd.read_json(path)
+
+class _ColumnWriter:
+    # Spools one column to temp files while rows stream in; the final type
+    # is only known once every value has been seen
+    def __init__(self, directory, rows_before):
+        self.blob = tempfile.TemporaryFile(dir=directory)
+        self.lengths = tempfile.TemporaryFile(dir=directory)
+        self.pending = array("q")
+        self.kinds = set()
+        for _ in range(rows_before):
+            self.add(None)
+
+    def add(self, value):
+        if value is None:
+            kind = "null"
+        elif isinstance(value, bool):
+            kind = "json"
+        elif isinstance(value, int):
+            kind = "int64"
+        elif isinstance(value, float):
+            kind = "float64"
+        elif isinstance(value, str):
+            kind = "str"
+        else:
+            kind = "json"
+        self.kinds.add(kind)
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.blob.write(data)
+        self.pending.append(len(data))
+        if len(self.pending) >= 65536:
+            self.flush()
+
+    def flush(self):
+        self.pending.tofile(self.lengths)
+        del self.pending[:]
+
+    def kind(self):
+        if self.kinds <= {"int64"}:
+            return "int64"
+        if self.kinds <= {"int64", "float64"}:
+            return "float64"
+        if self.kinds == {"str"}:
+            return "str"
+        return "json"
+
+    def values(self):
+        # Decoded values in row order, read back a chunk at a time
+        self.flush()
+        self.blob.seek(0)
+        self.lengths.seek(0)
+        while True:
+            lengths = np.fromfile(self.lengths, dtype=np.int64, count=65536)
+            if not len(lengths):
+                return
+            for length in lengths:
+                yield json.loads(self.blob.read(int(length)))
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % 8))
+
+def write_columns(records, path):
+    # Streams records (e.g. iter_records of a .json/.jsonl file) into a .cols
+    # file, atomically replacing path
+    directory = os.path.dirname(os.path.abspath(path))
+    writers = {}
+    rows = 0
+    for record in records:
+        for name in record:
+            if name not in writers:
+                writers[name] = _ColumnWriter(directory, rows)
+        for name, writer in writers.items():
+            writer.add(record.get(name))
+        rows += 1
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    body_path = tmp_path + ".body"
+    columns = []
+    with open(body_path, "wb") as body:
+        for name, writer in writers.items():
+            kind = writer.kind()
+            column = {"name": name, "kind": kind, "offset": body.tell()}
+            if kind in ("int64", "float64"):
+                values = np.fromiter(writer.values(), dtype=kind, count=rows)
+                body.write(values.tobytes())
+            else:
+                offsets = array("q", [0])
+                blob_path = body_path + ".blob"
+                with open(blob_path, "w+b") as blob:
+                    for value in writer.values():
+                        if kind == "str":
+                            blob.write(value.encode("utf-8"))
+                        else:
+                            blob.write(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+                        offsets.append(blob.tell())
+                    offsets.tofile(body)
+                    column["blob_offset"] = body.tell()
+                    blob.seek(0)
+                    while True:
+                        data = blob.read(1 << 20)
+                        if not data:
+                            break
+                        body.write(data)
+                os.remove(blob_path)
+            _pad(body)
+            columns.append(column)
+            writer.blob.close()
+            writer.lengths.close()
+
+    header = json.dumps({"rows": rows, "columns": columns}).encode("utf-8")
+    header += b" " * (-(len(columns_magic) + 8 + len(header)) % 8)
+    with open(tmp_path, "wb") as out, open(body_path, "rb") as body:
+        out.write(columns_magic)
+        out.write(struct.pack("<Q", len(header)))
+        out.write(header)
+        while True:
+            data = body.read(1 << 20)
+            if not data:
+                break
+            out.write(data)
+    os.remove(body_path)
+    os.replace(tmp_path, path)
+    return rows
+
+def write_table(records, path):
+    # Writes records in path's format and atomically replaces path: readers
+    # see the old file or the new one, never a partial write
+    if file_format(path) == "columns":
+        return write_columns(records, path)
+    rows = 0
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if file_format(path) == "jsonl":
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                rows += 1
+        else:
+            records = list(records)
+            json.dump(records, f, ensure_ascii=False, indent=4)
+            rows = len(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return rows
+
+class ColumnTable:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(columns_magic)) != columns_magic:
+                raise ValueError(f"{path}: not a columns file")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+        self.rows = header["rows"]
+        self.columns = header["columns"]
+        self._base = len(columns_magic) + 8 + header_length
+        self._data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > self._base else None
+
+    @property
+    def names(self):
+        return [column["name"] for column in self.columns]
+
+    def _offsets(self, column):
+        return np.frombuffer(self._data, dtype=np.int64, count=self.rows + 1, offset=self._base + column["offset"])
+
+    def column(self, name):
+        # numpy array for numeric columns, list of Python values otherwise
+        column = next(c for c in self.columns if c["name"] == name)
+        if column["kind"] in ("int64", "float64"):
+            if not self.rows:
+                return np.empty(0, dtype=column["kind"])
+            return np.frombuffer(self._data, dtype=column["kind"], count=self.rows,
+                                 offset=self._base + column["offset"])
+        return list(self._iter_column(column))
+
+    def _iter_column(self, column, start=0, stop=None):
+        if not self.rows:
+            return
+        offsets = self._offsets(column)
+        blob = self._base + column["blob_offset"]
+        for i in range(start, self.rows if stop is None else stop):
+            data = bytes(self._data[blob + offsets[i]:blob + offsets[i + 1]]).decode("utf-8")
+            yield data if column["kind"] == "str" else json.loads(data)
+
+    def iter_records(self, chunk_rows=4096):
+        for start in range(0, self.rows, chunk_rows):
+            stop = min(start + chunk_rows, self.rows)
+            values = []
+            for column in self.columns:
+                if column["kind"] in ("int64", "float64"):
+                    values.append(self.column(column["name"])[start:stop].tolist())
+                else:
+                    values.append(list(self._iter_column(column, start, stop)))
+            for row in zip(*values):
+                yield dict(zip(self.names, row))
+
+    def to_frame(self):
+        return pd.DataFrame({name: self.column(name) for name in self.names}, columns=self.names)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a .json/.jsonl catalog to another format")
+    parser.add_argument("source")
+    parser.add_argument("target", help="output path, .jsonl or .cols")
+    args = parser.parse_args()
+
+    if file_format(args.target) == "json":
+        raise SystemExit("target must end in .jsonl or .cols")
+    rows = write_table(iter_records(args.source), args.target)
+    print(f"{args.source} -> {args.target}: {rows} rows")
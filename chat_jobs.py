@@ -0,0 +1,138 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+
+import config
+import metrics
+
+# Chat answers are produced by a fixed pool of worker threads so neither the
+# Dash callback nor the JSON endpoints wait for generate(); the caller polls the
+# job and renders job.text as it grows. Jobs wait in a bounded queue, and
+# start_job raises ChatQueueFull instead of queueing past it.
+
+logger = logging.getLogger(__name__)
+
+job_ttl_seconds = 300
+
+class ChatQueueFull(Exception):
+    pass
+
+class ChatJob:
+    def __init__(self, question):
+        self.id = uuid.uuid4().hex
+        self.question = question
+        self.text = ""
+        self.done = False
+        self.error = None
+        self.usage = {}  # filled by the inference functions, e.g. generated_tokens
+        self.started = time.perf_counter()
+        self.running_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._changed = threading.Condition()
+
+    def append(self, chunk):
+        with self._changed:
+            if chunk and self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.text += chunk
+            self._changed.notify_all()
+
+    def finish(self, error=None):
+        with self._changed:
+            self.error = error
+            self.finished_at = time.perf_counter()
+            self.done = True
+            self._changed.notify_all()
+
+    def wait(self, seen=0, timeout=None):
+        # Long poll: blocks until text is longer than seen chars or the job is done
+        with self._changed:
+            self._changed.wait_for(lambda: self.done or len(self.text) > seen, timeout)
+            return self.text, self.done
+
+    def queue_wait(self):
+        if self.running_at is None:
+            return None
+        return self.running_at - self.started
+
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started
+
+    def total_latency(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started
+
+_jobs = {}
+_lock = threading.Lock()
+_queue = queue.Queue(maxsize=config.chat_queue_size)
+_workers = []
+
+def _run(job, stream_fn, args, kwargs):
+    job.running_at = time.perf_counter()
+    try:
+        for chunk in stream_fn(*args, usage=job.usage, **kwargs):
+            job.append(chunk)
+    except Exception as e:
+        logger.exception("Chat job failed: %s", e)
+        metrics.chat_jobs_finished.inc(outcome="error")
+        job.finish(str(e))
+    else:
+        metrics.chat_jobs_finished.inc(outcome="ok")
+        job.finish()
+
+def _work():
+    while True:
+        job, stream_fn, args, kwargs = _queue.get()
+        try:
+            _run(job, stream_fn, args, kwargs)
+        finally:
+            _queue.task_done()
+
+def _start_workers():
+    # Called with _lock held
+    while len(_workers) < config.chat_workers:
+        worker = threading.Thread(target=_work, name=f"chat-worker-{len(_workers)}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+def _prune():
+    now = time.perf_counter()
+    for job_id, job in list(_jobs.items()):
+        if job.done and now - job.finished_at > job_ttl_seconds:
+            del _jobs[job_id]
+
+def start_job(question, stream_fn, *args, **kwargs):
+    # stream_fn(*args, usage=job.usage, **kwargs) must return an iterator of text chunks
+    job = ChatJob(question)
+    with _lock:
+        _start_workers()
+        _prune()
+        try:
+            _queue.put_nowait((job, stream_fn, args, kwargs))
+        except queue.Full:
+            metrics.chat_jobs_finished.inc(outcome="rejected")
+            raise ChatQueueFull(f"{_queue.qsize()} chat answers are already waiting") from None
+        _jobs[job.id] = job
+    return job
+
+def queue_depth():
+    return _queue.qsize()
+
+metrics.register_callback("ecom_chat_queue_depth", "Chat answers waiting for a worker", "gauge",
+                          lambda: {(): queue_depth()})
+metrics.register_callback("ecom_chat_workers_busy", "Chat workers answering right now", "gauge",
+                          lambda: {(): _queue.unfinished_tasks - _queue.qsize()})
+
+def get_job(job_id):
+    with _lock:
+        return _jobs.get(job_id)
+
+def finish_job(job_id):
+    with _lock:
+        return _jobs.pop(job_id, None)
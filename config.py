@@ -0,0 +1,104 @@
+import os
+
+# Data files served by the app and indexed by the RAG layer
+products_path = os.environ.get("ECOM_PRODUCTS_PATH", "assets/products.json")
+users_path = os.environ.get("ECOM_USERS_PATH", "assets/user.json")
+
+# Sentence embedding model used for retrieval
+embedding_model_name = os.environ.get("ECOM_EMBEDDING_MODEL", "paraphrase-MiniLM-L6-v2")
+
+# Directory holding the memory-mapped embedding matrices and their manifests
+embedding_dir = os.environ.get("ECOM_EMBEDDING_DIR", "embeddings")
+
+# Retrieval index backend: "exact" (brute-force matmul) or "ivf" (approximate).
+# For ivf, ivf_lists=0 picks sqrt(rows); raising ivf_probe raises recall and latency.
+index_backend = os.environ.get("ECOM_INDEX_BACKEND", "exact")
+ivf_lists = int(os.environ.get("ECOM_IVF_LISTS", "0"))
+ivf_probe = int(os.environ.get("ECOM_IVF_PROBE", "8"))
+
+# Dynamic batching of generate() calls: a batch runs once it is full or the
+# oldest request has waited generation_max_wait_ms
+generation_max_batch_size = int(os.environ.get("ECOM_GEN_MAX_BATCH", "8"))
+generation_max_wait_ms = float(os.environ.get("ECOM_GEN_MAX_WAIT_MS", "5"))
+
+# Memory budget for cached system-block past_key_values per bot (0 disables)
+prefix_cache_bytes = int(float(os.environ.get("ECOM_PREFIX_CACHE_MB", "256")) * 1024 * 1024)
+
+# Retrieval (query -> row) and response caches, LRU with a time to live.
+# The catalog files are checked for changes at most every catalog_check_seconds.
+retrieval_cache_size = int(os.environ.get("ECOM_RETRIEVAL_CACHE_SIZE", "4096"))
+response_cache_size = int(os.environ.get("ECOM_RESPONSE_CACHE_SIZE", "1024"))
+cache_ttl_seconds = float(os.environ.get("ECOM_CACHE_TTL_SECONDS", "300"))
+catalog_check_seconds = float(os.environ.get("ECOM_CATALOG_CHECK_SECONDS", "1"))
+
+# Token for the /admin routes; when empty they only answer local requests
+admin_token = os.environ.get("ECOM_ADMIN_TOKEN", "")
+
+# Chat models. model_device is "auto" (cuda when available, else cpu), "cpu" or
+# "cuda[:n]"; a cuda device falls back to cpu when none is present.
+# model_quantize="int8" applies dynamic int8 quantization on cpu.
+prod_model_path = os.environ.get("ECOM_PROD_MODEL", "ecom_bot_prod")
+user_model_path = os.environ.get("ECOM_USER_MODEL", "ecom_bot_user")
+model_device = os.environ.get("ECOM_MODEL_DEVICE", "auto")
+model_quantize = os.environ.get("ECOM_MODEL_QUANTIZE", "none")
+
+# Chat answers run on chat_workers background threads. At most chat_queue_size
+# more wait for a worker; past that new questions get a "busy" reply.
+chat_workers = int(os.environ.get("ECOM_CHAT_WORKERS", "8"))
+chat_queue_size = int(os.environ.get("ECOM_CHAT_QUEUE_SIZE", "32"))
+
+# Embedding builds encode embedding_chunk_size rows per task, embedding_batch_size
+# per forward pass, spread over embedding_workers processes (1 = in process)
+embedding_batch_size = int(os.environ.get("ECOM_EMBEDDING_BATCH_SIZE", "64"))
+embedding_chunk_size = int(os.environ.get("ECOM_EMBEDDING_CHUNK_SIZE", "1024"))
+embedding_workers = int(os.environ.get("ECOM_EMBEDDING_WORKERS", "1"))
+
+# Speculative decoding: a small draft model (same tokenizer) proposes tokens
+# that the bot verifies. Off unless a draft is configured; speculative_decoding
+# is the default for the inference functions' speculative= switch.
+prod_draft_model_path = os.environ.get("ECOM_PROD_DRAFT_MODEL", "")
+user_draft_model_path = os.environ.get("ECOM_USER_DRAFT_MODEL", "")
+speculative_decoding = os.environ.get("ECOM_SPECULATIVE", "0") == "1"
+
+# Logging: ECOM_LOG_LEVEL for the app's loggers; per-request stage breakdowns
+# are logged for a log_sample_rate fraction of chat answers
+log_level = os.environ.get("ECOM_LOG_LEVEL", "INFO").upper()
+log_sample_rate = float(os.environ.get("ECOM_LOG_SAMPLE_RATE", "0.01"))
+
+# Chat memory: each session keeps its last session_max_turns turns per page as
+# token ids; prompts include the newest turns that fit in session_token_budget
+# tokens. Sessions expire after session_ttl_seconds idle, max_sessions at most.
+session_token_budget = int(os.environ.get("ECOM_SESSION_TOKEN_BUDGET", "384"))
+session_max_turns = int(os.environ.get("ECOM_SESSION_MAX_TURNS", "50"))
+session_ttl_seconds = float(os.environ.get("ECOM_SESSION_TTL_SECONDS", "1800"))
+max_sessions = int(os.environ.get("ECOM_MAX_SESSIONS", "10000"))
+
+# Hybrid retrieval: queries naming a product exactly skip the embedding model
+# (name_shortcut); otherwise hybrid_candidates dense and BM25 hits are ranked by
+# (1 - lexical_weight) * cosine + lexical_weight * BM25 / best BM25.
+# lexical_weight=0 is dense search only.
+name_shortcut = os.environ.get("ECOM_NAME_SHORTCUT", "1") == "1"
+lexical_weight = float(os.environ.get("ECOM_LEXICAL_WEIGHT", "0.3"))
+hybrid_candidates = int(os.environ.get("ECOM_HYBRID_CANDIDATES", "20"))
+
+# Chats on a /<Product_Name> page answer from that product's row directly and
+# only search when the question names a different product
+page_fast_path = os.environ.get("ECOM_PAGE_FAST_PATH", "1") == "1"
+
+# Rule engine: product questions about one field (price, warranty, refund,
+# stock, size, reviews) get a templated answer from the row when the intent
+# classifier's best cosine is >= rule_min_score and rule_min_margin above the rest
+rule_answers = os.environ.get("ECOM_RULE_ANSWERS", "1") == "1"
+rule_min_score = float(os.environ.get("ECOM_RULE_MIN_SCORE", "0.6"))
+rule_min_margin = float(os.environ.get("ECOM_RULE_MIN_MARGIN", "0.05"))
+
+# Order actions from the user bot (initiate_refund, change_location,
+# cancel_order) change the in-memory order store and are appended to
+# orders_journal_path; changes made within order_flush_ms share one write and
+# fsync. After order_compact_entries journal lines the users file is rewritten
+# atomically and the journal emptied. Orders without a user_id field belong
+# to default_user_id (the app has no login).
+orders_journal_path = os.environ.get("ECOM_ORDERS_JOURNAL", users_path + ".journal")
+order_flush_ms = float(os.environ.get("ECOM_ORDER_FLUSH_MS", "20"))
+order_compact_entries = int(os.environ.get("ECOM_ORDER_COMPACT_ENTRIES", "1000"))
+default_user_id = os.environ.get("ECOM_DEFAULT_USER_ID", "demo")
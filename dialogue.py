@@ -0,0 +1,97 @@
+class DialogueTemplate():
+    system_token = "<|system|>" #system prompt
+    user_token = "<|user|>"
+    assistant_token = "<|assistant|>"
+    end_token = "<|end|>"
+
+    messages = []
+
+    # def __init__(self, tokenizer):
+    #     self.tokenizer = tokenizer
+
+    def get_special_tokens(self):
+        return [self.system_token,self.user_token, self.assistant_token, self.end_token]
+
+    # system_token: system_prompt <end>
+    # user_token: user_msg_1 <end>
+    # assistant model_ans_1 <end>
+    # user........
+    # <|assistant|> for inference (add during inference so model pretends to be an assistant)
+
+    def get_system_prompt(self):
+        # The product block, identical for every question about the same row
+        keys = ["product_name","price","warranty","refundable", "inventory","dimensions","reviews", "description"]
+        # keys = ["order_status","product_name","refundable","days_since_ordered"]
+        sys_string = ""
+        for key in keys:
+          if key in self.message.keys() and len(str(self.message[key])) > 0:
+            sys_string += key + ": " + str(self.message[key]) + "\n"
+          # else:
+            # sys_string += key + ': ""\n'
+        return self.system_token + "\n" + sys_string  + self.end_token + "\n"
+
+    def get_training_prompt(self, infer = False):
+        prompt = self.get_system_prompt()
+        prompt += self.user_token + "\n" + self.message["user_question"] + self.end_token + "\n"
+        try:
+            prompt += self.assistant_token + "\n" + self.message["support_answer"] + self.end_token + "\n"
+        except:
+            pass
+            # elif message["role"] == "system":
+            #     prompt += self.system_token + "\n" + message["value"] + self.end_token + "\n"
+        if infer == False:
+          prompt += '<|endoftext|>'
+        # prompt = prompt +  ' <|endoftext|>'
+        return prompt #fully formed tranining prompt
+
+    def get_user_turn(self, question):
+        return self.user_token + "\n" + question + self.end_token + "\n"
+
+    def get_assistant_turn(self, answer):
+        return self.assistant_token + "\n" + answer + self.end_token + "\n"
+
+    def get_inference_prompt(self):
+        prompt = self.get_training_prompt(infer=True)
+        prompt += self.assistant_token
+        return prompt
+
+    def get_raw_dialogue(self):
+        prompt = ''
+        for message in self.messages:
+            prompt += message["content"] + '\n'
+
+        return prompt
+
+    def prepare_dialogue(self, example):
+        if 'content' in example.keys() and example['content'] is not None:
+            self.messages = example['content']
+        else:
+            # print("Invalid conversations")
+            pass
+
+        self.message = example
+
+        example['text'] = self.get_training_prompt()
+        return example
+
+def get_dialogue_template():
+    return DialogueTemplate()
+
+# examples = {
+#         "product_name":"Compact Microwave",
+#         "price":"",
+#         "warranty":"",
+#         "refundable":"returnable within 20 days",
+#         "inventory":"",
+#         "dimensions":"",
+#         "reviews":"",
+#         "description":"",
+#         "user_question":"I'd like to cancel my compact microwave order that was placed a while ago. Can you assist?",
+#         "support_answer":"The order is within the 20-day return period. I'll proceed with the cancellation now. cancel_order('Compact Microwave')",
+#         "order_status":"ordered",
+#         "days_since_ordered":10.0
+#     }
+# dialogue_template = get_dialogue_template()
+# dialogue_template.message = examples
+# print("Training:",dialogue_template.get_training_prompt())
+# print("Infering:", dialogue_template.get_inference_prompt())
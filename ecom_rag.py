@@ -1,240 +1,493 @@
-import os
+import time
+import logging
+import threading
 import numpy as np
-import pandas as pd
-import torch
-from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
-
-import torch
-class DialogueTemplate():
-    system_token = "<|system|>" #system prompt
-    user_token = "<|user|>"
-    assistant_token = "<|assistant|>"
-    end_token = "<|end|>"
-
-    messages = []
-
-    # def __init__(self, tokenizer):
-    #     self.tokenizer = tokenizer
-
-    def get_special_tokens(self):
-        return [self.system_token,self.user_token, self.assistant_token, self.end_token]
-
-    # system_token: system_prompt <end>
-    # user_token: user_msg_1 <end>
-    # assistant model_ans_1 <end>
-    # user........
-    # <|assistant|> for inference (add during inference so model pretends to be an assistant)
-
-    def get_training_prompt(self, infer = False):
-        keys = ["product_name","price","warranty","refundable", "inventory","dimensions","reviews", "description"]
-        # keys = ["order_status","product_name","refundable","days_since_ordered"]
-        sys_string = ""
-        for key in keys:
-          if key in self.message.keys() and len(str(self.message[key])) > 0:
-            sys_string += key + ": " + str(self.message[key]) + "\n"
-          # else:
-            # sys_string += key + ': ""\n'
-        prompt = self.system_token + "\n" + sys_string  + self.end_token + "\n"
-        prompt += self.user_token + "\n" + self.message["user_question"] + self.end_token + "\n"
-        try:
-            prompt += self.assistant_token + "\n" + self.message["support_answer"] + self.end_token + "\n"
-        except:
-            pass
-            # elif message["role"] == "system":
-            #     prompt += self.system_token + "\n" + message["value"] + self.end_token + "\n"
-        if infer == False:
-          prompt += '<|endoftext|>'
-        # prompt = prompt +  ' <|endoftext|>'
-        return prompt #fully formed tranining prompt
-
-    def get_inference_prompt(self):
-        prompt = self.get_training_prompt(infer=True)
-        prompt += self.assistant_token
-        return prompt
-
-    def get_raw_dialogue(self):
-        prompt = ''
-        for message in self.messages:
-            prompt += message["content"] + '\n'
-
-        return prompt
-
-    def prepare_dialogue(self, example):
-        if 'content' in example.keys() and example['content'] is not None:
-            self.messages = example['content']
-        else:
-            # print("Invalid conversations")
-            pass
-
-        self.message = example
-
-        example['text'] = self.get_training_prompt()
-        return example
-
-def get_dialogue_template():
-    return DialogueTemplate()
-
-# examples = {
-#         "product_name":"Compact Microwave",
-#         "price":"",
-#         "warranty":"",
-#         "refundable":"returnable within 20 days",
-#         "inventory":"",
-#         "dimensions":"",
-#         "reviews":"",
-#         "description":"",
-#         "user_question":"I'd like to cancel my compact microwave order that was placed a while ago. Can you assist?",
-#         "support_answer":"The order is within the 20-day return period. I'll proceed with the cancellation now. cancel_order('Compact Microwave')",
-#         "order_status":"ordered",
-#         "days_since_ordered":10.0
-#     }
-# dialogue_template = get_dialogue_template()
-# dialogue_template.message = examples
-# print("Training:",dialogue_template.get_training_prompt())
-# print("Infering:", dialogue_template.get_inference_prompt())
-
-import os
-import json
-import torch
-from torch.utils.data import DataLoader, random_split
-from torch.optim import AdamW
-from torch.optim.lr_scheduler import CosineAnnealingLR
-from transformers import AutoModelForCausalLM, AutoTokenizer, get_linear_schedule_with_warmup
-from tqdm import tqdm
-
-modelname = r"ecom_bot_prod"
-model_username = r"ecom_bot_user"
-
-model = AutoModelForCausalLM.from_pretrained(modelname).to("cuda")
-tokenizer = AutoTokenizer.from_pretrained(modelname)
-
-model_user = AutoModelForCausalLM.from_pretrained(model_username).to("cuda")
-tokenizer_user = AutoTokenizer.from_pretrained(model_username)
-
-print("Loaded prod bot")
 
+import config
+import catalog
+import metrics
+import embedding_store
+import intents
+import orders
+import retrieval
+from generation_server import BatchedGenerator
+from prefix_cache import PrefixCache
+from model_loading import LazyModel, resolve_device
+from response_cache import TTLCache, CatalogWatcher, normalize_question, text_hash
+from dialogue import get_dialogue_template
+
+logger = logging.getLogger(__name__)
+
+modelname = config.prod_model_path
+model_username = config.user_model_path
+
+def stop_token_ids(tokenizer):
+    # An answer is over at the dialogue end token, the bots were trained to
+    # close every assistant turn with it
+    vocab = tokenizer.get_vocab()
+    tokens = [get_dialogue_template().end_token, tokenizer.eos_token]
+    return [vocab[token] for token in tokens if token in vocab]
+
+def make_generator(model, tokenizer, device):
+    prefix_cache = None
+    if config.prefix_cache_bytes:
+        prefix_cache = PrefixCache(model, device, config.prefix_cache_bytes)
+    return BatchedGenerator(model, tokenizer, device=device, max_batch_size=config.generation_max_batch_size,
+                            max_wait_ms=config.generation_max_wait_ms, prefix_cache=prefix_cache,
+                            eos_token_id=stop_token_ids(tokenizer))
+
+# Loaded on the first chat for each bot, not at import. All generate() calls
+# go through the generator built here so concurrent chats share batches.
+prod_model = LazyModel(modelname, config.model_device, config.model_quantize, build=make_generator)
+user_model = LazyModel(model_username, config.model_device, config.model_quantize, build=make_generator)
+
+def make_draft(path):
+    return LazyModel(path, config.model_device, config.model_quantize) if path else None
+
+# Draft models for speculative decoding, None when not configured
+prod_draft = make_draft(config.prod_draft_model_path)
+user_draft = make_draft(config.user_draft_model_path)
+
+# Fields of the BM25 index, names count twice (see retrieval.BM25Index)
 search_tags = ['description', 'product_name']
+search_tag_weights = {'product_name': 2.0}
+
+def index_options():
+    if config.index_backend == "ivf":
+        return {"n_lists": config.ivf_lists, "n_probe": config.ivf_probe}
+    return {}
+
+class RagState:
+    # One consistent version of the tables, their embeddings and indexes.
+    # data_rag swaps the whole object on reload; readers grab it once.
+    def __init__(self, version, table, table_user):
+        self.version = version
+        self.table = table
+        self.table_user = table_user
+
+    def lookup(self, table_name):
+        # (table, dense index, lexical index, normalized embeddings)
+        if table_name == "products":
+            return self.table, self.doc_index, self.doc_lexical, self.doc_embeddings
+        return self.table_user, self.user_index, self.user_lexical, self.user_embeddings
 
 class data_rag:
     def __init__(self, table, table_user):
-        self.table = table #csv or json
-        self.table_user = table_user
-
         # self.table.drop('support_answer',inplace=True, axis='columns')
-        self.model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-        self.doc_embeddings = [
-            self.model.encode(f"{row['product_name']} {row['description']}")
-            for _, row in table.iterrows()
-        ]
-
-        self.user_embeddings = [
-            self.model.encode(f"{row['product_name']}")
-            for _, row in table_user.iterrows()
-        ]
+        self.model = SentenceTransformer(config.embedding_model_name, device=resolve_device(config.model_device))
+        self.state = None
+        self.reload(table, table_user)
+
+    @property
+    def table(self):
+        return self.state.table #csv or json
+
+    @property
+    def table_user(self):
+        return self.state.table_user
+
+    @property
+    def doc_index(self):
+        return self.state.doc_index
+
+    @property
+    def user_index(self):
+        return self.state.user_index
+
+    def _embed(self, name, texts):
+        # Memory-mapped matrix, only rows whose text changed get re-encoded
+        encoded = embedding_store.build_embeddings(name, texts, self.model)
+        matrix, manifest = embedding_store.load_embeddings(name)
+        if manifest is None:
+            # Another process replaced the matrix (and removed ours) between
+            # the build and the load, or the file is unreadable: build again
+            encoded += embedding_store.build_embeddings(name, texts, self.model)
+            matrix, manifest = embedding_store.load_embeddings(name)
+        if manifest is None:
+            raise RuntimeError(f"{name} embeddings in {config.embedding_dir} are unreadable right after building them")
+        return matrix, manifest["hashes"], encoded
+
+    def reload(self, table, table_user):
+        # Builds the new state next to the live one and swaps it in with one
+        # assignment, so in-flight searches finish on the state they started with
+        previous = self.state
+        state = RagState(previous.version + 1 if previous else 0, table, table_user)
+        state.doc_embeddings, state.doc_hashes, doc_encoded = self._embed(
+            "products", embedding_store.table_texts(table, embedding_store.product_text))
+        state.user_embeddings, state.user_hashes, user_encoded = self._embed(
+            "users", embedding_store.table_texts(table_user, embedding_store.user_text))
+        if previous is None:
+            state.doc_index = retrieval.build_index(state.doc_embeddings, config.index_backend, normalized=True,
+                                                    **index_options())
+            # Order lists are small, exact search is always cheapest there
+            state.user_index = retrieval.build_index(state.user_embeddings, "exact", normalized=True)
+        else:
+            state.doc_index = previous.doc_index.updated(
+                state.doc_embeddings, retrieval.previous_rows(previous.doc_hashes, state.doc_hashes), normalized=True)
+            state.user_index = previous.user_index.updated(
+                state.user_embeddings, retrieval.previous_rows(previous.user_hashes, state.user_hashes), normalized=True)
+        state.doc_lexical = retrieval.BM25Index(table.to_dict('records'), search_tags, search_tag_weights)
+        # /<Product_Name> page -> row, the last row wins like catalog.by_slug
+        state.doc_slugs = {catalog.slugify(name): position for position, name in enumerate(table['product_name'])}
+        state.user_lexical = retrieval.BM25Index(table_user.to_dict('records'), ['product_name'])
+        self.state = state
+        return {"products": doc_encoded, "users": user_encoded}
+
+    def reload_users(self, table_user):
+        # Order actions only change the users table, the product side is shared
+        previous = self.state
+        state = RagState(previous.version + 1, previous.table, table_user)
+        for name in ("doc_embeddings", "doc_hashes", "doc_index", "doc_lexical", "doc_slugs"):
+            setattr(state, name, getattr(previous, name))
+        state.user_embeddings, state.user_hashes, user_encoded = self._embed(
+            "users", embedding_store.table_texts(table_user, embedding_store.user_text))
+        state.user_index = previous.user_index.updated(
+            state.user_embeddings, retrieval.previous_rows(previous.user_hashes, state.user_hashes), normalized=True)
+        state.user_lexical = retrieval.BM25Index(table_user.to_dict('records'), ['product_name'])
+        self.state = state
+        return {"users": user_encoded}
 
     def search(self, query):
-        query_embedding = self.model.encode([query])
-        # Find similar documents
-        similarities = cosine_similarity(query_embedding, self.doc_embeddings)[0]
-        top_indices = similarities.argsort()[-5:][::-1]  # Get top 5 matches
-        context = []
-        # Context for generation
-        # print(list(self.table.iloc[i] for i in top_indices))
-        return list(self.table.iloc[i] for i in top_indices)[0]
-        # print(f"Search: {query} Result: {context}")
+        state = self.state
+        return state.table.iloc[self.search_position(query, "products", state)]
 
     def search_user(self, query):
-        query_embedding = self.model.encode([query])
-        # Find similar documents
-        similarities = cosine_similarity(query_embedding, self.user_embeddings)[0]
-        top_indices = similarities.argsort()[-5:][::-1]  # Get top 5 matches
-        context = []
-        # Context for generation
-        # print(list(self.table.iloc[i] for i in top_indices))
-        return list(self.table_user.iloc[i] for i in top_indices)[0]
-        # print(f"Search: {query} Result: {context}")
-
-df = pd.read_json('assets/products.json')
-df_user = pd.read_json('assets/user.json')
-print(df.head(5))
+        state = self.state
+        return state.table_user.iloc[self.search_position(query, "users", state)]
+
+    def search_position(self, query, table_name="products", state=None, details=None):
+        # A query naming a product exactly is answered from the name index
+        # without running the embedding model; otherwise the dense candidates
+        # and the BM25 hits are re-ranked on a mix of both scores. A details
+        # dict gets the normalized query_embedding when one was computed.
+        state = state or self.state
+        _, index, lexical, embeddings = state.lookup(table_name)
+        if config.name_shortcut:
+            position = lexical.name_match(query)
+            if position is not None:
+                metrics.retrievals.inc(path="name")
+                return position
+        query_embedding = retrieval.normalize_rows(self.encode([query]))
+        if details is not None:
+            details["query_embedding"] = query_embedding[0]
+        if not config.lexical_weight:
+            metrics.retrievals.inc(path="dense")
+            with metrics.stage("search"):
+                indices, _ = index.search(query_embedding, 1)
+                if indices.shape[1] and indices[0][0] >= 0:
+                    return int(indices[0][0])
+                return self.exact_position(query_embedding, embeddings)
+        metrics.retrievals.inc(path="hybrid")
+        with metrics.stage("search"):
+            dense_rows, _ = index.search(query_embedding, config.hybrid_candidates)
+            dense_rows = dense_rows[0][dense_rows[0] >= 0]
+            lexical_rows, lexical_scores = lexical.search(query, config.hybrid_candidates)
+            rows = np.union1d(dense_rows, lexical_rows)
+            cosine = dict(zip(rows.tolist(), (embeddings[rows] @ query_embedding[0]).tolist()))
+            fused = retrieval.fuse(dense_rows.tolist(), cosine, lexical_rows, lexical_scores, config.lexical_weight)
+            if fused:
+                return fused[0]
+            return self.exact_position(query_embedding, embeddings)
+
+    def exact_position(self, query_embedding, embeddings):
+        # The IVF index returns -1 when every probed list is empty; an exact
+        # pass over the matrix still finds the best row
+        metrics.retrievals.inc(path="exact")
+        indices, _ = retrieval.DenseIndex(embeddings, normalized=True).search(query_embedding, 1)
+        return int(indices[0][0])
+
+    def encode(self, queries):
+        with metrics.stage("embed"):
+            return self.model.encode(list(queries), show_progress_bar=False)
+
+    def search_batch(self, queries, index=None, k=5):
+        # Top-k row indices and cosine scores for every query in one matmul
+        if index is None:
+            index = self.doc_index
+        query_embeddings = self.encode(queries)
+        with metrics.stage("search"):
+            return index.search(query_embeddings, k)
+
+df = catalog.store.snapshot.products
+df_user = catalog.store.snapshot.users
+logger.debug("Products:\n%s", df.head(5))
 
 erag = data_rag(df,df_user)
+intent_classifier = intents.IntentClassifier(erag.model, config.rule_min_score, config.rule_min_margin)
 
-def prod_inference(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None):
-    model.eval()
+def clean_response(text):
     dialogue_template = get_dialogue_template()
-    device = "cuda"
-    
-    if additional_context is not None:
-        additional_context = str(additional_context).strip()
-        # print("Additional context is:",additional_context) 
-        sys_search = erag.search(prompt + str(additional_context))
-    else:
-        sys_search = erag.search(prompt)
-    print("Searching result:", sys_search)
-    sys_search['user_question'] = prompt
-    dialogue_template.message = sys_search
-    input_text = dialogue_template.get_inference_prompt()
-    # print("the input prompt is: ", input_text)
-    inputs = tokenizer(input_text, return_tensors="pt",padding=True, truncation=True,max_length=1024).to(device)
-    input_ids = inputs['input_ids'].to(device)
-    attention_mask = inputs['attention_mask'].to(device)
-    output = model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        max_new_tokens=max_new_tokens,
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-        do_sample=True,
-        pad_token_id=tokenizer.pad_token_id
-    )
-
-    generated_text = tokenizer.decode(output[0], skip_special_tokens=False)
-    # return generated_text
-    response = generated_text.split(dialogue_template.assistant_token)[1].strip()
-    response = response.replace(dialogue_template.end_token, "").strip()
-    response = response.replace("<|endoftext|>", "").strip()
-    return response
-
-def user_inference(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None):
-    model.eval()
+    text = text.replace(dialogue_template.end_token, "")
+    return text.replace("<|endoftext|>", "")
+
+def decode_response(tokenizer, generated_ids):
+    # generated_ids holds only the new tokens, the prompt is never decoded
+    with metrics.stage("decode"):
+        return clean_response(tokenizer.decode(generated_ids, skip_special_tokens=False)).strip()
+
+def stream_response(tokenizer, token_stream):
+    # Yields the response text as it grows. The whole answer is re-decoded each
+    # step so multi-token characters and special tokens come out whole.
+    # Time between tokens counts as generate, re-decoding as decode.
+    generated_ids = []
+    emitted = 0
+    decode_seconds = 0.0
+    start = time.perf_counter()
+    for token_ids in token_stream:
+        decode_start = time.perf_counter()
+        generated_ids.extend(token_ids)
+        text = clean_response(tokenizer.decode(generated_ids, skip_special_tokens=False)).lstrip()
+        decode_seconds += time.perf_counter() - decode_start
+        if text.endswith("\ufffd"):
+            continue  # incomplete UTF-8 sequence, wait for the next token
+        if len(text) > emitted:
+            yield text[emitted:]
+            emitted = len(text)
+    metrics.observe_stage("generate", time.perf_counter() - start - decode_seconds)
+    decode_start = time.perf_counter()
+    text = clean_response(tokenizer.decode(generated_ids, skip_special_tokens=False)).lstrip()
+    metrics.observe_stage("decode", decode_seconds + time.perf_counter() - decode_start)
+    if len(text) > emitted:
+        yield text[emitted:]
+
+retrieval_cache = TTLCache(config.retrieval_cache_size, config.cache_ttl_seconds)
+response_cache = TTLCache(config.response_cache_size, config.cache_ttl_seconds)
+catalog_watcher = CatalogWatcher({"products": config.products_path, "users": config.users_path},
+                                 [retrieval_cache, response_cache], config.catalog_check_seconds)
+
+# Reentrant: catalog.store.load() flushes pending order actions, which calls
+# orders_changed from within reload_catalog
+reload_lock = threading.RLock()
+
+def reload_catalog():
+    # Re-reads products.json/user.json, re-embeds only added or changed rows
+    # and swaps the retrieval state and the page catalog in
+    with reload_lock:
+        snapshot = catalog.store.load()
+        encoded = erag.reload(snapshot.products, snapshot.users)
+        catalog.store.snapshot = snapshot
+    logger.info("Catalog reloaded, re-encoded rows: %s", encoded)
+    return encoded
+
+catalog_watcher.listeners.append(lambda table, changed: reload_catalog())
+catalog_watcher.start()
+
+def orders_changed(product_names):
+    # Called by the order store after each written batch of order actions
+    with reload_lock:
+        users = orders.store.frame()
+        erag.reload_users(users)
+        catalog.store.snapshot = catalog.store.snapshot.with_users(users)
+    for name in product_names:
+        for cache in (retrieval_cache, response_cache):
+            cache.invalidate_tag(("users", name))
+
+orders.store.listeners.append(orders_changed)
+
+def cached_search(table_name, query, details=None):
+    state = erag.state
+    table = state.lookup(table_name)[0]
+    # Row positions are only meaningful within one state version
+    key = (table_name, state.version, normalize_question(query))
+    with metrics.stage("retrieval"):
+        position = retrieval_cache.get(key)
+        if position is None:
+            position = erag.search_position(query, table_name, state, details)
+            retrieval_cache.put(key, position, tag=(table_name, table.iloc[position]['product_name']))
+        return table.iloc[position]
+
+def page_row(table_name, prompt, page_name):
+    # (row, names_other) for a chat on a product page: the page's own row
+    # unless the question names a different product, then (None, True).
+    # (None, False) when page_name is not a product.
+    state = erag.state
+    if table_name != "products" or not config.page_fast_path:
+        return None, False
+    position = state.doc_slugs.get(catalog.slugify(page_name))
+    if position is None:
+        return None, False
+    page_product = state.table.iloc[position]
+    named = state.doc_lexical.name_match(prompt)
+    if named is not None and state.table.iloc[named]['product_name'] != page_product['product_name']:
+        return None, True
+    return page_product, False
+
+def build_prompt(table_name, prompt, additional_context=None, details=None):
+    # details (optional dict) gets retrieval's query_embedding when the
+    # prompt alone was embedded, for the rule engine to reuse
     dialogue_template = get_dialogue_template()
-    device = "cuda"
     
     if additional_context is not None:
         additional_context = str(additional_context).strip()
-        # print("Additional context is:",additional_context) 
-        sys_search = erag.search_user(prompt + str(additional_context))
+        with metrics.stage("retrieval"):
+            sys_search, names_other = page_row(table_name, prompt, additional_context)
+        if sys_search is not None:
+            metrics.retrievals.inc(path="page")
+        elif names_other:
+            # Asked about another product from this page, search for that one
+            sys_search = cached_search(table_name, prompt, details)
+        else:
+            sys_search = cached_search(table_name, prompt + str(additional_context))
     else:
-        sys_search = erag.search_user(prompt)
-    print("Searching result:", sys_search)
-    sys_search['user_question'] = prompt
-    dialogue_template.message = sys_search
-    input_text = dialogue_template.get_inference_prompt()
-    # print("the input prompt is: ", input_text)
-    inputs = tokenizer_user(input_text, return_tensors="pt",padding=True, truncation=True,max_length=1024).to(device)
-    input_ids = inputs['input_ids'].to(device)
-    attention_mask = inputs['attention_mask'].to(device)
-    output = model_user.generate(
-        input_ids,
-        attention_mask=attention_mask,
+        sys_search = cached_search(table_name, prompt, details)
+    logger.debug("Search result for %r: %s", prompt, sys_search['product_name'])
+    with metrics.stage("prompt"):
+        sys_search['user_question'] = prompt
+        dialogue_template.message = sys_search
+        # (row, system block, user turn), the system block is what PrefixCache keys on
+        system_prompt = dialogue_template.get_system_prompt()
+        return sys_search, system_prompt, dialogue_template.get_inference_prompt()[len(system_prompt):]
+
+def prod_prompt(prompt, additional_context=None):
+    return build_prompt("products", prompt, additional_context)
+
+def user_prompt(prompt, additional_context=None):
+    return build_prompt("users", prompt, additional_context)
+
+# bot -> (lazily loaded model, draft model or None, table its rows come from)
+bots = {
+    "prod": (prod_model, prod_draft, "products"),
+    "user": (user_model, user_draft, "users"),
+}
+
+def loaded_generators():
+    return {bot: bot_model.get()[3] for bot, (bot_model, _, _) in bots.items() if bot_model.loaded}
+
+def cache_counts(attribute):
+    # hits or misses of the retrieval/response caches and each loaded bot's prefix cache
+    counts = {("retrieval",): getattr(retrieval_cache, attribute), ("response",): getattr(response_cache, attribute)}
+    for bot, generator in loaded_generators().items():
+        if generator.prefix_cache is not None:
+            counts[(f"prefix_{bot}",)] = getattr(generator.prefix_cache, attribute)
+    return counts
+
+metrics.register_callback("ecom_cache_hits_total", "Cache hits", "counter",
+                          lambda: cache_counts("hits"), labels=("cache",))
+metrics.register_callback("ecom_cache_misses_total", "Cache misses", "counter",
+                          lambda: cache_counts("misses"), labels=("cache",))
+metrics.register_callback("ecom_generation_queue_depth", "Requests waiting for a generate() batch", "gauge",
+                          lambda: {(bot,): generator.queue_depth() for bot, generator in loaded_generators().items()},
+                          labels=("bot",))
+
+def prepare_inference(bot, prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative=None,
+                      conversation=None):
+    bot_model, draft, table_name = bots[bot]
+    _, bot_tokenizer, _, generator = bot_model.get()
+    details = {}
+    row, system_prompt, input_text = build_prompt(table_name, prompt, additional_context, details)
+    # Earlier turns of the conversation, already token ids, trimmed to the budget
+    context_ids = conversation.context_ids(config.session_token_budget) if conversation is not None else []
+    # The system block hash changes whenever the row's attributes change
+    cache_key = (bot, text_hash(system_prompt), normalize_question(prompt), (max_new_tokens, temperature, top_k, top_p),
+                 text_hash(str(context_ids)) if context_ids else None)
+    cache_tag = (table_name, row['product_name'])
+    generate_kwargs = dict(
+        prefix=system_prompt,
         max_new_tokens=max_new_tokens,
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
-        do_sample=True,
-        pad_token_id=tokenizer.pad_token_id
+        do_sample=True
     )
-
-    generated_text = tokenizer_user.decode(output[0], skip_special_tokens=False)
-    # return generated_text
-    response = generated_text.split(dialogue_template.assistant_token)[1].strip()
-    response = response.replace(dialogue_template.end_token, "").strip()
-    response = response.replace("<|endoftext|>", "").strip()
-    return response
+    if context_ids:
+        generate_kwargs["context_ids"] = context_ids
+    if config.speculative_decoding if speculative is None else speculative:
+        if draft is None:
+            if metrics.sampled():
+                logger.warning("Speculative decoding requested but no draft model is configured for %s", bot)
+        else:
+            generate_kwargs["assistant_model"] = draft.get()[0]
+    ruled = rule_answer(bot, prompt, row, details.get("query_embedding"))
+    return generator, bot_tokenizer, input_text, generate_kwargs, cache_key, cache_tag, ruled
+
+def rule_answer(bot, prompt, row, query_embedding=None):
+    # Templated answer for single-field product questions, None to generate.
+    # Never embeds the question itself (see intents)
+    if bot != "prod" or not config.rule_answers:
+        return None
+    intent, _ = intent_classifier.classify(prompt, row['product_name'], query_embedding)
+    return intents.answer(intent, row) if intent is not None else None
+
+def record_usage(bot, usage, generated_tokens, source, started):
+    # usage is an optional dict the caller passes in to learn what a request
+    # cost; source is "model", "cache" or "rule"
+    metrics.request_seconds.observe(time.perf_counter() - started, bot=bot, source=source)
+    metrics.answers.inc(bot=bot, source=source)
+    metrics.generated_tokens.inc(generated_tokens, bot=bot)
+    if usage is not None:
+        usage["generated_tokens"] = generated_tokens
+        usage["cached"] = source == "cache"
+        usage["source"] = source
+
+def remember(conversation, tokenizer, prompt, response):
+    if conversation is not None:
+        conversation.add(tokenizer, prompt, response)
+
+def run_inference(bot, prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative=None,
+                  usage=None, conversation=None):
+    started = time.perf_counter()
+    with metrics.trace(bot):
+        generator, bot_tokenizer, input_text, generate_kwargs, cache_key, cache_tag, ruled = prepare_inference(
+            bot, prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, conversation)
+        if ruled is not None:
+            record_usage(bot, usage, 0, "rule", started)
+            remember(conversation, bot_tokenizer, prompt, ruled)
+            return ruled
+        response = response_cache.get(cache_key)
+        if response is not None:
+            record_usage(bot, usage, 0, "cache", started)
+            remember(conversation, bot_tokenizer, prompt, response)
+            return response
+        with metrics.stage("generate"):
+            generated_ids = generator.generate(input_text, **generate_kwargs)
+        response = decode_response(bot_tokenizer, generated_ids)
+        response_cache.put(cache_key, response, cache_tag)
+        record_usage(bot, usage, len(generated_ids), "model", started)
+        remember(conversation, bot_tokenizer, prompt, response)
+        return response
+
+def run_inference_stream(bot, prompt, max_new_tokens, temperature, top_k, top_p, additional_context,
+                         speculative=None, usage=None, conversation=None):
+    started = time.perf_counter()
+    with metrics.trace(bot):
+        generator, bot_tokenizer, input_text, generate_kwargs, cache_key, cache_tag, ruled = prepare_inference(
+            bot, prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, conversation)
+        if ruled is not None:
+            record_usage(bot, usage, 0, "rule", started)
+            remember(conversation, bot_tokenizer, prompt, ruled)
+            yield ruled
+            return
+        response = response_cache.get(cache_key)
+        if response is not None:
+            record_usage(bot, usage, 0, "cache", started)
+            remember(conversation, bot_tokenizer, prompt, response)
+            yield response
+            return
+        response = ""
+        token_stream = generator.submit_stream(input_text, **generate_kwargs)
+        for chunk in stream_response(bot_tokenizer, token_stream):
+            response += chunk
+            yield chunk
+        response_cache.put(cache_key, response.strip(), cache_tag)
+        record_usage(bot, usage, token_stream.generated_tokens, "model", started)
+        remember(conversation, bot_tokenizer, prompt, response.strip())
+
+def prod_inference(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None, speculative=None, usage=None, conversation=None):
+    return run_inference("prod", prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, usage, conversation)
+
+def user_inference(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None, speculative=None, usage=None, conversation=None):
+    return run_inference("user", prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, usage, conversation)
+
+def prod_inference_stream(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None, speculative=None, usage=None, conversation=None):
+    # Same as prod_inference but yields chunks of the answer while it is generated.
+    # speculative=True verifies draft model proposals (None: config default),
+    # a usage dict gets the generated token count once the answer is done and
+    # a sessions.Conversation supplies earlier turns and records this one
+    return run_inference_stream("prod", prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, usage, conversation)
+
+def user_inference_stream(prompt,max_new_tokens=128, temperature=0.3, top_k=100,top_p=0.95, additional_context=None, speculative=None, usage=None, conversation=None):
+    return run_inference_stream("user", prompt, max_new_tokens, temperature, top_k, top_p, additional_context, speculative, usage, conversation)
 
 # if __name__ == "__main__":
 
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+
+import config
+import catalog_io
+from retrieval import normalize_rows
+
+# On-disk layout (per table name, e.g. "products"):
+#   <name>.manifest.json   model name, dim and one content hash per row
+#   <name>-<digest>.npy    float32 matrix, row i is the unit-norm embedding of row i
+# The manifest is replaced last, so readers always see a complete matrix.
+# Matrices are opened with mmap_mode='r' so every process shares the same pages.
+# Rows are encoded chunk_size at a time and written straight into the new
+# matrix; with workers > 1 the chunks are spread over a process pool whose
+# workers each load the model and open the matrix read-write themselves.
+
+logger = logging.getLogger(__name__)
+
+manifest_version = 2
+
+def product_text(row):
+    return f"{row['product_name']} {row['description']}"
+
+def user_text(row):
+    return f"{row['product_name']}"
+
+def table_texts(table, text_fn):
+    return [text_fn(row) for row in table.to_dict('records')]
+
+class FileTexts:
+    # Texts of a catalog file, re-read one record at a time on every pass
+    # instead of kept in memory
+    def __init__(self, path, text_fn):
+        self.path = path
+        self.text_fn = text_fn
+
+    def __iter__(self):
+        return (self.text_fn(record) for record in catalog_io.iter_records(self.path))
+
+def row_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _manifest_path(name, directory):
+    return os.path.join(directory, name + ".manifest.json")
+
+def read_manifest(name, directory=None):
+    directory = directory or config.embedding_dir
+    try:
+        with open(_manifest_path(name, directory), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != manifest_version:
+        return None
+    return manifest
+
+def load_embeddings(name, directory=None):
+    directory = directory or config.embedding_dir
+    manifest = read_manifest(name, directory)
+    if manifest is None:
+        return None, None
+    try:
+        matrix = np.load(os.path.join(directory, manifest["file"]), mmap_mode="r")
+    except (OSError, ValueError):
+        return None, None
+    if matrix.shape != (len(manifest["hashes"]), manifest["dim"]):
+        return None, None
+    return matrix, manifest
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _encode_chunk(model, path, chunk, batch_size):
+    # chunk: [(row position, text), ...]
+    positions = [position for position, _ in chunk]
+    out = np.load(path, mmap_mode="r+")
+    out[positions] = normalize_rows(model.encode([text for _, text in chunk], batch_size=batch_size))
+    out.flush()
+    return len(chunk)
+
+_worker_model = None
+
+def _init_worker(model_name, threads):
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    # Split the cores between workers instead of every worker using all of them
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+def _worker_encode(args):
+    return _encode_chunk(_worker_model, *args)
+
+def encode_into(path, rows, model, model_name, batch_size=64, chunk_size=1024, workers=1):
+    # Encodes (position, text) rows into the .npy matrix at path.
+    # Returns (rows encoded, seconds).
+    start = time.perf_counter()
+    chunks = iter_chunks(rows, chunk_size)
+    encoded = 0
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # spawn: forking a process that already runs torch threads can deadlock
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(model_name, threads))
+        try:
+            for count in pool.imap_unordered(_worker_encode, ((path, chunk, batch_size) for chunk in chunks)):
+                encoded += count
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for chunk in chunks:
+            encoded += _encode_chunk(model, path, chunk, batch_size)
+    return encoded, time.perf_counter() - start
+
+def _write_json(path, obj):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+def build_embeddings(name, texts, model, model_name=None, directory=None, batch_size=None, chunk_size=None,
+                     workers=None):
+    # Re-encodes only rows whose text hash is not in the current manifest.
+    # texts is iterated twice (hashes, then rows to encode), so it can be a
+    # FileTexts. Returns the number of rows that had to be encoded.
+    directory = directory or config.embedding_dir
+    model_name = model_name or config.embedding_model_name
+    batch_size = batch_size or config.embedding_batch_size
+    chunk_size = chunk_size or config.embedding_chunk_size
+    workers = config.embedding_workers if workers is None else workers
+    os.makedirs(directory, exist_ok=True)
+
+    hashes = [row_hash(text) for text in texts]
+    old_matrix, old_manifest = load_embeddings(name, directory)
+    reuse = {}
+    if old_manifest is not None and old_manifest["model"] == model_name:
+        reuse = {h: i for i, h in enumerate(old_manifest["hashes"])}
+
+    digest = hashlib.sha1((model_name + "".join(hashes)).encode("utf-8")).hexdigest()[:16]
+    file_name = f"{name}-{digest}.npy"
+    if old_manifest is not None and old_manifest["file"] == file_name:
+        return 0
+
+    todo = [i for i, h in enumerate(hashes) if h not in reuse]
+    if reuse:
+        dim = old_manifest["dim"]
+    else:
+        dim = model.get_sentence_embedding_dimension()
+
+    tmp_path = os.path.join(directory, f"{file_name}.{os.getpid()}.tmp.npy")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(hashes), dim))
+    for i, h in enumerate(hashes):
+        if h in reuse:
+            out[i] = old_matrix[reuse[h]]
+    out.flush()
+    del out
+    if todo:
+        # A pool only pays for its start-up on large jobs, reloads of a few rows stay in process
+        pool_workers = workers if len(todo) > chunk_size else 1
+        todo_rows = set(todo)
+        rows = ((i, text) for i, text in enumerate(texts) if i in todo_rows)
+        encoded, seconds = encode_into(tmp_path, rows, model, model_name,
+                                       batch_size, chunk_size, pool_workers)
+        logger.info("Encoded %d %s rows in %.1fs (%.0f rows/s, %d worker%s)", encoded, name, seconds,
+                    encoded / max(seconds, 1e-9), pool_workers, "s" if pool_workers > 1 else "")
+    os.replace(tmp_path, os.path.join(directory, file_name))
+
+    _write_json(_manifest_path(name, directory), {
+        "version": manifest_version,
+        "model": model_name,
+        "dim": int(dim),
+        "file": file_name,
+        "hashes": hashes,
+    })
+
+    # Old matrix stays readable for processes that already mapped it
+    if old_manifest is not None and old_manifest["file"] != file_name:
+        try:
+            os.remove(os.path.join(directory, old_manifest["file"]))
+        except OSError:
+            pass
+    return len(todo)
+
+if __name__ == "__main__":
+    import argparse
+    from sentence_transformers import SentenceTransformer
+
+    parser = argparse.ArgumentParser(description="Build the embedding matrices for the catalog tables")
+    parser.add_argument("--workers", type=int, default=config.embedding_workers)
+    parser.add_argument("--batch-size", type=int, default=config.embedding_batch_size)
+    parser.add_argument("--chunk-size", type=int, default=config.embedding_chunk_size)
+    parser.add_argument("--rebuild", action="store_true", help="re-encode every row, e.g. to measure throughput")
+    args = parser.parse_args()
+    logging.basicConfig(level=config.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    model = SentenceTransformer(config.embedding_model_name, device="cpu")
+    for name, path, text_fn in [("products", config.products_path, product_text),
+                                ("users", config.users_path, user_text)]:
+        manifest = read_manifest(name)
+        if args.rebuild and manifest is not None:
+            for file_name in (manifest["file"], os.path.basename(_manifest_path(name, config.embedding_dir))):
+                os.remove(os.path.join(config.embedding_dir, file_name))
+        texts = FileTexts(path, text_fn)
+        encoded = build_embeddings(name, texts, model, batch_size=args.batch_size,
+                                   chunk_size=args.chunk_size, workers=args.workers)
+        print(f"{name}: {len(read_manifest(name)['hashes'])} rows, {encoded} encoded")
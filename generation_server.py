@@ -0,0 +1,222 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+import metrics
+
+# Coalesces concurrent generate() calls for one model into batches. Callers
+# submit a prompt and block on a Future; a single worker thread waits up to
+# max_wait_ms for more requests (up to max_batch_size), left-pads them into
+# one tensor, runs one model.generate and hands each caller its new token ids.
+# Requests only share a batch when their generation kwargs are identical.
+# submit_stream() additionally yields token ids as each decoding step finishes.
+# context_ids (earlier turns, already tokenized) go between prefix and prompt.
+# A prompt can carry a prefix (the system block); when such a request ends up
+# alone in its batch and a PrefixCache is attached, the prefix's
+# past_key_values are reused instead of being prefilled again.
+# Requests with an assistant_model (speculative decoding) always run one at a
+# time, assisted generation only handles a single sequence.
+# eos_token_id (one id or a list, e.g. the dialogue end token) stops each
+# row as soon as it is produced; callers get the ids before the stop token.
+
+_stream_end = object()
+
+class TokenStream:
+    # Iterator over the token ids of one request, fed by the generator worker
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self.generated_tokens = 0
+
+    def put(self, token_ids):
+        self.generated_tokens += len(token_ids)
+        self._queue.put(token_ids)
+
+    def close(self, error=None):
+        self._error = error
+        self._queue.put(_stream_end)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _stream_end:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+
+class _BatchStreamer(BaseStreamer):
+    # Routes each step's (batch,) tokens to the per-request streams
+    def __init__(self, requests, pad_token_id, stop_token_ids):
+        self.requests = requests
+        self.pad_token_id = pad_token_id
+        self.stop_token_ids = stop_token_ids
+        self.stopped = [False] * len(requests)
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            # generate() pushes the padded prompt first
+            self.prompt_seen = True
+            return
+        rows = value.tolist()
+        for row, (request, tokens) in enumerate(zip(self.requests, rows)):
+            if request.stream is None or self.stopped[row]:
+                continue
+            tokens = [tokens] if isinstance(tokens, int) else tokens
+            tokens, self.stopped[row] = trim_tokens(tokens, self.pad_token_id, self.stop_token_ids)
+            if tokens:
+                request.stream.put(tokens)
+
+    def end(self):
+        pass
+
+def trim_tokens(tokens, pad_token_id, stop_token_ids):
+    # (ids before the first stop token without padding, whether one was found).
+    # Rows that already finished keep receiving padding.
+    kept = []
+    for token in tokens:
+        if token in stop_token_ids:
+            return kept, True
+        if token != pad_token_id:
+            kept.append(token)
+    return kept, False
+
+class GenerationRequest:
+    def __init__(self, input_ids, generate_kwargs, stream=None, prefix=None, prefix_length=0):
+        self.input_ids = input_ids
+        self.prefix = prefix
+        self.prefix_length = prefix_length
+        self.generate_kwargs = generate_kwargs
+        self.key = tuple(sorted(generate_kwargs.items()))
+        self.future = Future()
+        self.stream = stream
+
+class BatchedGenerator:
+    def __init__(self, model, tokenizer, device="cpu", max_batch_size=8, max_wait_ms=5, max_length=1024,
+                 prefix_cache=None, eos_token_id=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_length = max_length
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = []
+        self.eos_token_id = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+        self.stop_token_ids = set(self.eos_token_id)
+        self.batches_run = 0
+        self.requests_run = 0
+        self.tokens_generated = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, prompt, prefix="", context_ids=None, **generate_kwargs):
+        return self._enqueue(prompt, prefix, context_ids, generate_kwargs).future
+
+    def submit_stream(self, prompt, prefix="", context_ids=None, **generate_kwargs):
+        return self._enqueue(prompt, prefix, context_ids, generate_kwargs, TokenStream()).stream
+
+    def _enqueue(self, prompt, prefix, context_ids, generate_kwargs, stream=None):
+        # Tokenize on the caller's thread, the worker only runs the model.
+        # Prefix and prompt are tokenized apart so the prefix ids never depend
+        # on what follows them.
+        with metrics.stage("tokenize"):
+            prefix_ids = self.tokenizer(prefix)['input_ids'] if prefix else []
+            input_ids = (prefix_ids + list(context_ids or []) + self.tokenizer(prompt)['input_ids'])[:self.max_length]
+        if len(prefix_ids) >= len(input_ids):
+            prefix, prefix_ids = None, []
+        request = GenerationRequest(input_ids, generate_kwargs, stream, prefix or None, len(prefix_ids))
+        self._ensure_worker()
+        self._queue.put(request)
+        return request
+
+    def generate(self, prompt, **generate_kwargs):
+        return self.submit(prompt, **generate_kwargs).result()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._loop, name="batched-generator", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            groups = {}
+            for request in self._collect():
+                if "assistant_model" in request.generate_kwargs:
+                    groups[id(request)] = [request]
+                else:
+                    groups.setdefault(request.key, []).append(request)
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, group):
+        self.batches_run += 1
+        self.requests_run += len(group)
+        metrics.generation_batch_size.observe(len(group))
+        try:
+            width = max(len(request.input_ids) for request in group)
+            input_ids = torch.full((len(group), width), self.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(group), width), dtype=torch.long)
+            for row, request in enumerate(group):
+                # Left-align padding so every prompt ends where generation starts
+                length = len(request.input_ids)
+                input_ids[row, width - length:] = torch.tensor(request.input_ids, dtype=torch.long)
+                attention_mask[row, width - length:] = 1
+            streamer = None
+            if any(request.stream is not None for request in group):
+                streamer = _BatchStreamer(group, self.pad_token_id, self.stop_token_ids)
+            extra_kwargs = {}
+            if self.eos_token_id and "eos_token_id" not in group[0].generate_kwargs:
+                extra_kwargs["eos_token_id"] = self.eos_token_id
+            if len(group) == 1 and group[0].prefix is not None and self.prefix_cache is not None:
+                request = group[0]
+                extra_kwargs["past_key_values"] = self.prefix_cache.lookup(
+                    request.prefix, request.input_ids[:request.prefix_length])
+            with torch.no_grad():
+                output = self.model.generate(
+                    input_ids.to(self.device),
+                    attention_mask=attention_mask.to(self.device),
+                    pad_token_id=self.pad_token_id,
+                    streamer=streamer,
+                    **extra_kwargs,
+                    **group[0].generate_kwargs
+                )
+            new_tokens = output[:, width:].tolist()
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+                if request.stream is not None:
+                    request.stream.close(e)
+            return
+        for request, tokens in zip(group, new_tokens):
+            # Finished rows are padded out to the longest one in the batch
+            tokens, _ = trim_tokens(tokens, self.pad_token_id, self.stop_token_ids)
+            self.tokens_generated += len(tokens)
+            request.future.set_result(tokens)
+            if request.stream is not None:
+                request.stream.close()
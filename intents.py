@@ -0,0 +1,162 @@
+import re
+import threading
+
+import numpy as np
+
+import metrics
+import retrieval
+
+# Questions about a single catalog field (price, warranty, refund policy,
+# stock, size, rating) are answered from the product row with a template
+# instead of the chat model. Classifying never runs the embedding model: a
+# short question that names exactly one field (keywords below) and nothing
+# open-ended is matched lexically. Otherwise, when retrieval already embedded
+# the question, that embedding is compared with a few example questions per
+# intent; "other" holds open-ended examples so questions near them fall
+# through to generation. An embedding match is only used when it clears
+# min_score and beats every other intent by min_margin.
+
+prototypes = {
+    "price": ["What is the price?", "How much does it cost?", "How much is it?", "What does this cost?",
+              "Is it expensive?", "What's the price of this product?"],
+    "warranty": ["What is the warranty?", "Does it come with a warranty?", "How long is the warranty?",
+                 "Is it covered by a guarantee?", "What warranty does it have?"],
+    "refundable": ["Is it refundable?", "Can I return it?", "Can I get a refund?", "What is the return policy?",
+                   "Is this product returnable?"],
+    "inventory": ["Is it in stock?", "How many are in stock?", "How many are available?",
+                  "How many of these are in inventory?", "Is it available right now?"],
+    "dimensions": ["What are the dimensions?", "How big is it?", "What size is it?", "How large is it?",
+                   "What are its measurements?"],
+    "reviews": ["What are the reviews like?", "How is it rated?", "What do customers think of it?",
+                "What is the rating?", "Is it well reviewed?"],
+    "other": ["How do I set it up?", "Is it good for a small apartment?", "Can you tell me about this product?",
+              "How does it compare to other products?", "What features does it have?", "Is it easy to clean?",
+              "Does it work with my phone?", "What is it made of?", "Which one should I buy?",
+              "Can I use it outdoors?"],
+}
+
+# Whole-word cues per field, on the lowercased question with the product name
+# replaced by "it"; open_ended cues send a question to the model regardless
+keywords = {
+    "price": re.compile(r"\b(price|prices|priced|cost|costs|how much is it|how much does it cost)\b"),
+    "warranty": re.compile(r"\b(warranty|warranties|guarantee|guaranteed)\b"),
+    "refundable": re.compile(r"\b(refund|refunds|refundable|returnable|return policy|return it)\b"),
+    "inventory": re.compile(r"\b(in stock|stock|inventory|how many are available)\b"),
+    "dimensions": re.compile(r"\b(dimensions|dimension|measurements|measure|measures|how big|how large|what size)\b"),
+    "reviews": re.compile(r"\b(reviews|reviewed|review|rating|ratings|rated)\b"),
+}
+open_ended = re.compile(r"\b(compare|compared|comparison|versus|vs|better|best|recommend|should|which|why|worth|"
+                        r"other|alternative|alternatives|and|or)\b")
+
+def match_keywords(question):
+    # The one field a short question asks about, None if none or several
+    question = question.lower()
+    if open_ended.search(question):
+        return None
+    matched = [intent for intent, pattern in keywords.items() if pattern.search(question)]
+    return matched[0] if len(matched) == 1 else None
+
+def _field(text):
+    return str(text).strip().rstrip(".")
+
+def answer_price(name, row):
+    return f"The {name} costs {_field(row['price'])}."
+
+def answer_warranty(name, row):
+    warranty = _field(row['warranty'])
+    if "warranty" in warranty.lower():
+        return f"The {name} comes with a {warranty}."
+    return f"The {name} comes with a warranty of {warranty}."
+
+def answer_refundable(name, row):
+    policy = _field(row['refundable'])
+    lower = policy.lower()
+    if lower.startswith("no"):
+        return f"Sorry, the {name} is not refundable."
+    if lower.startswith("yes"):
+        detail = policy[3:].strip(" ,")
+        return f"Yes, the {name} is refundable{', ' + detail if detail else ''}."
+    return f"The refund policy for the {name} is: {policy}."
+
+def answer_inventory(name, row):
+    inventory = row['inventory']
+    if isinstance(inventory, (int, np.integer)) or str(inventory).strip().isdigit():
+        inventory = int(inventory)
+        if inventory <= 0:
+            return f"Sorry, the {name} is out of stock right now."
+        inventory = f"{inventory} units"
+    return f"We currently have {_field(inventory)} of the {name} in stock."
+
+def answer_dimensions(name, row):
+    return f"The {name} measures {_field(row['dimensions'])}."
+
+def answer_reviews(name, row):
+    return f"The {name} is rated {_field(row['reviews'])}."
+
+answer_templates = {
+    "price": answer_price,
+    "warranty": answer_warranty,
+    "refundable": answer_refundable,
+    "inventory": answer_inventory,
+    "dimensions": answer_dimensions,
+    "reviews": answer_reviews,
+}
+
+class IntentClassifier:
+    def __init__(self, model, min_score=0.6, min_margin=0.05, max_words=16):
+        self.model = model
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.max_words = max_words
+        self.intents = list(prototypes)
+        self._labels = None
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def _prototypes(self):
+        # Encoded on first use, the embedding model is already loaded for retrieval
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    texts = [text for intent in self.intents for text in prototypes[intent]]
+                    labels = [i for i, intent in enumerate(self.intents) for _ in prototypes[intent]]
+                    matrix = retrieval.normalize_rows(self.model.encode(texts, show_progress_bar=False))
+                    self._labels = np.asarray(labels)
+                    self._matrix = matrix
+        return self._matrix, self._labels
+
+    def classify(self, question, product_name=None, query_embedding=None):
+        # (intent, score); intent is None when no field intent is clear enough.
+        # A keyword match scores 1.0. query_embedding is retrieval's embedding
+        # of the same question; without one only keywords are tried. The
+        # product's name is replaced by "it" for the keywords so a name like
+        # "Price Tracker" does not count as asking about the price.
+        question = str(question)
+        if len(question.split()) > self.max_words:
+            return None, 0.0
+        if product_name:
+            question = re.sub(r"\b(the\s+)?" + re.escape(str(product_name)), "it", question, flags=re.IGNORECASE)
+        intent = match_keywords(question)
+        if intent is not None:
+            metrics.rule_matches.inc(method="keywords")
+            return intent, 1.0
+        if query_embedding is None:
+            return None, 0.0
+        matrix, labels = self._prototypes()
+        query = retrieval.normalize_rows(np.atleast_2d(query_embedding))[0]
+        similarity = matrix @ query
+        best = np.full(len(self.intents), -1.0)
+        np.maximum.at(best, labels, similarity)
+        order = np.argsort(-best)
+        intent, score = self.intents[order[0]], float(best[order[0]])
+        if intent == "other" or score < self.min_score or score - best[order[1]] < self.min_margin:
+            return None, score
+        metrics.rule_matches.inc(method="embedding")
+        return intent, score
+
+def answer(intent, row):
+    # Templated reply from the row, None when the field is empty
+    value = row.get(intent)
+    if value is None or (isinstance(value, float) and np.isnan(value)) or not str(value).strip():
+        return None
+    return answer_templates[intent](row['product_name'], row)
@@ -0,0 +1,224 @@
+import math
+import time
+import random
+import numbers
+import logging
+import threading
+from contextlib import contextmanager
+
+import config
+
+# In-process counters and latency histograms for the chat pipeline, rendered
+# in the Prometheus text format by the /metrics route. Values that other
+# objects already keep (cache hits, queue depths) are read through callbacks
+# at scrape time instead of being mirrored here.
+#
+# stage("retrieval") times one pipeline step into ecom_stage_seconds{stage=...}.
+# Inside a trace() the same timings are also collected per request, and a
+# sampled fraction of requests (config.log_sample_rate) logs its breakdown.
+
+logger = logging.getLogger(__name__)
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+    return "{" + pairs + "}"
+
+def _value_text(value):
+    # Exact: counters and sums grow past what a short float format keeps
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, values in self._values.items():
+                for bound, count in zip(self.buckets, values):
+                    samples.append((self.name + "_bucket", key + (repr(bound),), count))
+                samples.append((self.name + "_bucket", key + ("+Inf",), values[-1]))
+                samples.append((self.name + "_sum", key, values[-2]))
+                samples.append((self.name + "_count", key, values[-1]))
+        return samples
+
+    def sample_labels(self, sample_name):
+        return self.labels + ("le",) if sample_name.endswith("_bucket") else self.labels
+
+class Callback:
+    # Reads its values from fn() at scrape time: {label values tuple: value}
+    def __init__(self, name, help, kind, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.fn().items()]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.warning("metric %s failed: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, key, value in samples:
+                names = metric.sample_labels(sample_name) if hasattr(metric, "sample_labels") else metric.labels
+                lines.append(f"{sample_name}{_label_text(names, key)} {_value_text(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "ecom_stage_seconds", "Time spent in each chat pipeline stage", labels=("stage",)))
+request_seconds = registry.register(Histogram(
+    "ecom_chat_request_seconds", "End-to-end answer time per bot and answer source (model, cache, rule)",
+    labels=("bot", "source")))
+answers = registry.register(Counter(
+    "ecom_answers_total", "Answers per bot and source: model, cache or rule (templated, no generation)",
+    labels=("bot", "source")))
+rule_matches = registry.register(Counter(
+    "ecom_rule_matches_total", "Questions the rule engine matched to a field, by method: keywords or embedding",
+    labels=("method",)))
+generated_tokens = registry.register(Counter(
+    "ecom_generated_tokens_total", "Tokens generated per bot", labels=("bot",)))
+generation_batch_size = registry.register(Histogram(
+    "ecom_generation_batch_size", "Requests per generate() call", buckets=(1, 2, 4, 8, 16, 32)))
+retrievals = registry.register(Counter(
+    "ecom_retrievals_total", "Row lookups by path: page (product page row), name (no embedding), hybrid or dense, "
+    "plus exact when an approximate search came back empty", labels=("path",)))
+chat_jobs_finished = registry.register(Counter(
+    "ecom_chat_jobs_total", "Chat jobs by outcome", labels=("outcome",)))
+tool_calls = registry.register(Counter(
+    "ecom_tool_calls_total", "Order actions from user bot answers by tool and outcome (done, rejected)",
+    labels=("tool", "outcome")))
+
+def register_callback(name, help, kind, fn, labels=()):
+    return registry.register(Callback(name, help, kind, fn, labels))
+
+def answer_share(bot, sources):
+    # Fraction of the bot's answers that came from the given sources
+    counts = {source: answers.value(bot=bot, source=source) for source in ("model", "cache", "rule")}
+    total = sum(counts.values())
+    return sum(counts[source] for source in sources) / total if total else 0.0
+
+register_callback("ecom_rule_bypass_ratio", "Share of product answers given by the rule engine", "gauge",
+                  lambda: {(): answer_share("prod", ["rule"])})
+register_callback("ecom_generation_bypass_ratio", "Share of product answers given without generation", "gauge",
+                  lambda: {(): answer_share("prod", ["rule", "cache"])})
+
+def render():
+    return registry.render()
+
+_local = threading.local()
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def summary(self):
+        total = time.perf_counter() - self.started
+        parts = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in self.stages.items())
+        return f"{self.name} total={total * 1000:.1f}ms {parts}"
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.add(stage, seconds)
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+@contextmanager
+def trace(name):
+    # Collects the stages run on this thread until the block ends
+    previous = getattr(_local, "trace", None)
+    current = _local.trace = Trace(name)
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+        if sampled():
+            logger.info("trace %s", current.summary())
+
+def sampled(rate=None):
+    # True for a random fraction of calls, for logging on hot paths
+    rate = config.log_sample_rate if rate is None else rate
+    return rate >= 1 or (rate > 0 and random.random() < rate)
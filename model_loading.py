@@ -0,0 +1,87 @@
+import time
+import logging
+import threading
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.pytorch_utils import Conv1D
+
+# Chat models are loaded on first use instead of at import, on the device
+# picked by config.model_device ("auto" prefers cuda and falls back to cpu).
+# quantize="int8" applies torch dynamic quantization to the Linear layers,
+# which only runs on cpu.
+
+logger = logging.getLogger(__name__)
+
+def resolve_device(requested="auto"):
+    if requested == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if requested.startswith("cuda") and not torch.cuda.is_available():
+        logger.warning("Device %s requested but cuda is not available, using cpu", requested)
+        return "cpu"
+    return requested
+
+def conv1d_to_linear(model):
+    # GPT-2 style Conv1D keeps its weight as (in, out); quantize_dynamic only
+    # knows nn.Linear, which stores (out, in)
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = torch.nn.Parameter(child.bias.detach().clone())
+                setattr(module, child_name, linear)
+    return model
+
+def quantize_int8(model):
+    conv1d_to_linear(model)
+    # The output head shares its weight with the input embedding, quantizing
+    # it would untie the two and store the vocabulary matrix twice
+    output_embeddings = model.get_output_embeddings()
+    names = {name for name, module in model.named_modules()
+             if isinstance(module, torch.nn.Linear) and module is not output_embeddings}
+    return torch.ao.quantization.quantize_dynamic(model, {name: torch.ao.quantization.default_dynamic_qconfig
+                                                          for name in names}, dtype=torch.qint8)
+
+def load_causal_lm(path, device="auto", quantize="none"):
+    device = resolve_device(device)
+    model = AutoModelForCausalLM.from_pretrained(path)
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    if quantize == "int8":
+        if device == "cpu":
+            model = quantize_int8(model)
+        else:
+            logger.warning("int8 dynamic quantization is cpu only, loading %s unquantized on %s", path, device)
+    elif quantize != "none":
+        raise ValueError(f"Unknown quantization mode: {quantize}")
+    return model.to(device).eval(), tokenizer, device
+
+class LazyModel:
+    # Loads the model the first time it is needed; concurrent first callers
+    # wait for the same load. build(model, tokenizer, device) can wrap the
+    # loaded model (e.g. in a BatchedGenerator) and its result is kept too.
+    def __init__(self, path, device="auto", quantize="none", build=None):
+        self.path = path
+        self.device = device
+        self.quantize = quantize
+        self.build = build
+        self.load_seconds = None
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded is not None
+
+    def get(self):
+        # (model, tokenizer, device, built)
+        if self._loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    start = time.perf_counter()
+                    model, tokenizer, device = load_causal_lm(self.path, self.device, self.quantize)
+                    built = self.build(model, tokenizer, device) if self.build else None
+                    self.load_seconds = time.perf_counter() - start
+                    logger.info("Loaded %s on %s (%s) in %.1fs", self.path, device, self.quantize, self.load_seconds)
+                    self._loaded = (model, tokenizer, device, built)
+        return self._loaded
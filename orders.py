@@ -0,0 +1,264 @@
+import os
+import json
+import logging
+import threading
+
+import pandas as pd
+
+import config
+import metrics
+import catalog_io
+
+# Orders the user bot can act on. The users file is read once into memory with
+# indexes by product name and by user; an action changes one order in place
+# and appends {"order_id", "product_name", "set"} to a journal. A flusher
+# thread writes every change made within order_flush_ms with one write and
+# fsync, so concurrent sessions share the cost, and an action returns once its
+# line is on disk. Loading replays the journal over the users file and never
+# writes either. After compact_entries lines the users file is rewritten
+# atomically (catalog_io.write_table) and the journal emptied; replaying a line
+# twice is harmless, every line sets values.
+
+logger = logging.getLogger(__name__)
+
+closed_statuses = ("refund_in_progress", "refunded", "cancelled")
+
+def normalize_name(name):
+    return " ".join(str(name).lower().split())
+
+class OrderError(Exception):
+    # An action the order does not allow, the message is shown to the customer
+    pass
+
+class OrderStore:
+    def __init__(self, path, journal_path, flush_ms=20, compact_entries=1000, default_user_id="demo"):
+        self.path = path
+        self.journal_path = journal_path
+        self.flush_seconds = flush_ms / 1000
+        self.compact_entries = compact_entries
+        self.default_user_id = default_user_id
+        self.listeners = []  # called with the product names of every flushed batch
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._pending = []
+        self._sequence = 0
+        self._flushed_sequence = 0
+        self._flusher = None
+        self.load()
+
+    def load(self):
+        records = list(catalog_io.iter_records(self.path))
+        # Orders without an order_id field get their row number, in memory
+        # only; a compaction writes the ids out with the changed orders
+        for position, record in enumerate(records, 1):
+            record.setdefault("order_id", position)
+        self.records = records
+        self.by_id = {record["order_id"]: record for record in records}
+        self.journal_entries = self._replay()
+        self._index()
+        self._file_mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _replay(self):
+        # The journal is bounded by compaction, so it is read whole
+        try:
+            with open(self.journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            # A write cut short by a crash, never acknowledged; cut it off so
+            # the next batch does not land on the same line
+            logger.warning("Dropping a partial line at the end of %s", self.journal_path)
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(complete)
+        entries = 0
+        for line_number, line in enumerate(data[:complete].decode("utf-8").splitlines(), 1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping unreadable journal line %s:%s", self.journal_path, line_number)
+                continue
+            record = self.by_id.get(entry["order_id"])
+            # Row-number ids move when the file is edited by hand, the name
+            # keeps a line from landing on another order
+            if record is not None and record["product_name"] == entry.get("product_name", record["product_name"]):
+                record.update(entry["set"])
+            entries += 1
+        return entries
+
+    def _index(self):
+        self.by_product = {}
+        self.by_user = {}
+        for record in self.records:
+            self.by_product.setdefault(normalize_name(record["product_name"]), []).append(record["order_id"])
+            self.by_user.setdefault(self._user(record), []).append(record["order_id"])
+
+    def _user(self, record):
+        return record.get("user_id") or self.default_user_id
+
+    def reload(self):
+        # For CatalogWatcher: re-read the users file if something other than
+        # this store changed it. Pending changes are written first, and the
+        # listeners hear of them like of any other batch.
+        self.flush()
+        with self._write_lock, self._lock:
+            if self._mtime() != self._file_mtime:
+                self.load()
+
+    def frame(self):
+        with self._lock:
+            return pd.DataFrame.from_records([dict(record) for record in self.records])
+
+    def user_orders(self, user_id):
+        with self._lock:
+            return [dict(self.by_id[order_id]) for order_id in self.by_user.get(user_id, [])]
+
+    def _find(self, user_id, product_name):
+        # The user's orders of product_name: exact name first, else the orders
+        # whose name contains it (or is contained in it) when they are all one product
+        key = normalize_name(product_name)
+        own = set(self.by_user.get(user_id, []))
+        exact = [order_id for order_id in self.by_product.get(key, []) if order_id in own]
+        if exact or not key:
+            return [self.by_id[order_id] for order_id in exact]
+        names = {normalize_name(self.by_id[order_id]["product_name"]) for order_id in own}
+        partial = [name for name in names if key in name or name in key]
+        if len(partial) != 1:
+            return []
+        return [self.by_id[order_id] for order_id in self.by_product[partial[0]] if order_id in own]
+
+    def initiate_refund(self, user_id, product_name):
+        def check(record):
+            if str(record.get("refundable", "")).lower().startswith("no"):
+                raise OrderError(f"the {record['product_name']} is not refundable")
+            return {"order_status": "refund_in_progress"}
+        return self._apply(user_id, product_name, check)
+
+    def change_location(self, user_id, product_name, location):
+        location = str(location).strip()
+        if not location:
+            raise OrderError("no new location was given")
+
+        def check(record):
+            if record.get("order_status") == "delivered":
+                raise OrderError(f"the {record['product_name']} was already delivered")
+            return {"location": location}
+        return self._apply(user_id, product_name, check)
+
+    def cancel_order(self, user_id, product_name):
+        def check(record):
+            if record.get("order_status") == "delivered":
+                raise OrderError(f"the {record['product_name']} was already delivered, ask for a refund instead")
+            return {"order_status": "cancelled"}
+        return self._apply(user_id, product_name, check)
+
+    def _apply(self, user_id, product_name, check):
+        # Checks and changes the first open order of the product under the
+        # lock, so two sessions acting on one order cannot both succeed, then
+        # waits for the change to be written
+        with self._lock:
+            records = self._find(user_id, product_name)
+            if not records:
+                raise OrderError(f"there is no order for {product_name}")
+            open_records = [record for record in records if record.get("order_status") not in closed_statuses]
+            if not open_records:
+                raise OrderError(f"the {records[0]['product_name']} order is already "
+                                 f"{str(records[0].get('order_status')).replace('_', ' ')}")
+            record = open_records[0]
+            changes = check(record)
+            record.update(changes)
+            self._sequence += 1
+            sequence = self._sequence
+            self._pending.append({"order_id": record["order_id"], "product_name": record["product_name"],
+                                  "set": changes})
+            self._start_flusher()
+            self._flushed.notify_all()
+            while self._flushed_sequence < sequence:
+                self._flushed.wait()
+            return dict(record)
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name="order-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            with self._lock:
+                self._flushed.wait_for(lambda: self._pending)
+            # Let the changes of concurrent sessions pile up into one write
+            threading.Event().wait(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Order journal write failed, retrying: %s", e)
+                threading.Event().wait(1.0)
+
+    def flush(self):
+        # Writes the queued changes as one journal append. The listeners see
+        # them before the actions are acknowledged, so the views built from
+        # the store (retrieval state, order page) already show a reply's change.
+        with self._write_lock:
+            with self._lock:
+                batch = list(self._pending)
+                sequence = self._sequence
+            if batch:
+                lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self._lock:
+                    # Changes queued during the write stay for the next batch
+                    del self._pending[:len(batch)]
+                    self.journal_entries += len(batch)
+                    self.flushes += 1
+        if batch:
+            names = sorted({self.by_id[entry["order_id"]]["product_name"] for entry in batch})
+            for listener in self.listeners:
+                try:
+                    listener(names)
+                except Exception as e:
+                    logger.exception("Order listener failed: %s", e)
+            with self._lock:
+                self._flushed_sequence = max(self._flushed_sequence, sequence)
+                self._flushed.notify_all()
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        with self._write_lock:
+            with self._lock:
+                if self.journal_entries < self.compact_entries:
+                    return
+                records = [dict(record) for record in self.records]
+                entries = self.journal_entries
+            self._compact(records, entries)
+
+    def _compact(self, records, entries):
+        # Runs under _write_lock, so no journal line is written meanwhile; the
+        # snapshot holds every line written so far (and maybe queued changes,
+        # which replaying their lines later just sets again)
+        catalog_io.write_table(records, self.path)
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self.journal_entries -= entries
+            self._file_mtime = self._mtime()
+
+store = OrderStore(config.users_path, config.orders_journal_path, config.order_flush_ms,
+                   config.order_compact_entries, config.default_user_id)
+
+metrics.register_callback("ecom_order_journal_flushes_total", "Order journal writes, each one fsync", "counter",
+                          lambda: {(): store.flushes})
+metrics.register_callback("ecom_order_journal_entries", "Order changes in the journal since the last compaction",
+                          "gauge", lambda: {(): store.journal_entries})
@@ -0,0 +1,56 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+# past_key_values for rendered system blocks, so follow-up questions about the
+# same product only prefill the new user turn. Entries are evicted least
+# recently used first once their estimated size passes max_bytes.
+
+class PrefixCache:
+    def __init__(self, model, device="cpu", max_bytes=256 * 1024 * 1024):
+        self.model = model
+        self.device = device
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry_bytes(self, length):
+        # keys + values for every layer
+        element_size = next(self.model.parameters()).element_size()
+        return 2 * self.model.config.num_hidden_layers * length * self.model.config.hidden_size * element_size
+
+    def lookup(self, key, prefix_ids):
+        # Returns a private copy, generate() extends the cache in place
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[0])
+            self.misses += 1
+
+        with torch.no_grad():
+            input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.device)
+            past_key_values = self.model(input_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+
+        size = self._entry_bytes(len(prefix_ids))
+        if size <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (past_key_values, size)
+                    self.bytes_used += size
+                while self.bytes_used > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.bytes_used -= evicted_size
+        return copy.deepcopy(past_key_values)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes_used = 0
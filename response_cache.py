@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import catalog_io
+
+# Two caches sit in front of the chat pipeline (see ecom_rag):
+#   retrieval: (table, state version, normalized query) -> row position
+#   response:  (bot, system block hash, question, sampling params) -> answer
+# A retrieval entry keys on the version of the state it was searched in,
+# since a reload renumbers rows.
+# Entries are tagged with the (table, product_name) they were built from, and
+# CatalogWatcher drops every entry of a record whose JSON changed on disk.
+
+logger = logging.getLogger(__name__)
+
+def normalize_question(text):
+    text = re.sub(r"\s+", " ", str(text).strip().lower())
+    return text.rstrip("?!. ")
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class TTLCache:
+    # LRU with a per-entry time to live
+    def __init__(self, max_entries=1024, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, tag=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, tag = self._entries.pop(key)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hit_rate()}
+
+def record_hashes(path):
+    hashes = {}
+    for record in catalog_io.iter_records(path):
+        name = record.get("product_name")
+        # Duplicate names share a tag, so hash them together
+        hashes[name] = text_hash(hashes.get(name, "") + json.dumps(record, sort_keys=True))
+    return hashes
+
+class CatalogWatcher:
+    # Stats the watched JSON files at most once per interval; when one changed,
+    # diffs its records by product_name, invalidates the matching cache tags and
+    # tells the listeners.
+    def __init__(self, tables, caches, interval_seconds=1.0):
+        self.tables = dict(tables)  # table name -> path
+        self.caches = list(caches)
+        self.interval_seconds = interval_seconds
+        self.listeners = []
+        self._next_check = 0.0
+        self._mtimes = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        for table, path in self.tables.items():
+            self._mtimes[table] = self._mtime(path)
+            self._hashes[table] = record_hashes(path)
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def start(self):
+        # Poll from a daemon thread so reloads never run on a request thread
+        thread = threading.Thread(target=self._poll, name="catalog-watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                self.maybe_check()
+            except Exception as e:
+                logger.exception("Catalog check failed: %s", e)
+
+    def maybe_check(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.interval_seconds
+            for table, path in self.tables.items():
+                mtime = self._mtime(path)
+                if mtime != self._mtimes[table]:
+                    self._mtimes[table] = mtime
+                    self._reload(table, path)
+        finally:
+            self._lock.release()
+
+    def _reload(self, table, path):
+        try:
+            hashes = record_hashes(path)
+        except (OSError, ValueError) as e:
+            # Half-written file, try again on the next check
+            logger.warning("Catalog reload failed for %s: %s", table, e)
+            self._mtimes[table] = None
+            return
+        old = self._hashes[table]
+        changed = [name for name in set(old) | set(hashes) if old.get(name) != hashes.get(name)]
+        self._hashes[table] = hashes
+        for name in changed:
+            for cache in self.caches:
+                cache.invalidate_tag((table, name))
+        for listener in self.listeners:
+            listener(table, changed)
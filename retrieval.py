@@ -0,0 +1,255 @@
+import re
+import math
+
+import numpy as np
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def top_k(scores, k):
+    # Row-wise top-k of a (queries, rows) score matrix, best first
+    n = scores.shape[1]
+    k = min(k, n)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+class DenseIndex:
+    # Exact cosine search over one contiguous float32 matrix of unit rows.
+    # Pass normalized=True for matrices stored pre-normalized (e.g. the
+    # memory-mapped ones from embedding_store) so they are used without a copy.
+    def __init__(self, embeddings, normalized=False):
+        if normalized:
+            self.matrix = np.asarray(embeddings, dtype=np.float32)
+        else:
+            self.matrix = np.ascontiguousarray(normalize_rows(embeddings))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def updated(self, embeddings, previous_rows, normalized=False):
+        # Nothing is trained, wrapping the new matrix is all there is to do
+        return DenseIndex(embeddings, normalized=normalized)
+
+    def search(self, queries, k=5):
+        # queries: (dim,) or (n_queries, dim); returns (n_queries, k) indices and scores
+        queries = normalize_rows(np.atleast_2d(queries))
+        if len(self) == 0:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        scores = queries @ self.matrix.T
+        return top_k(scores, k)
+
+class IVFIndex:
+    # Approximate cosine search: rows are clustered with spherical k-means and
+    # stored grouped by cluster, a query only scores the n_probe closest
+    # clusters. n_lists and n_probe trade recall against latency; with
+    # n_probe >= n_lists the result is exact.
+    def __init__(self, embeddings, n_lists=0, n_probe=8, normalized=False, n_iter=10, seed=0,
+                 centroids=None, labels=None):
+        matrix = np.asarray(embeddings, dtype=np.float32) if normalized else normalize_rows(embeddings)
+        n = matrix.shape[0]
+        self.n_probe = n_probe
+        if centroids is None:
+            self.n_lists = max(1, min(n_lists or int(np.sqrt(n)), n))
+            self.centroids = self._train(matrix, n_iter, seed)
+        else:
+            self.n_lists = centroids.shape[0]
+            self.centroids = centroids
+
+        assignment = labels if labels is not None else self._assign(matrix)
+        self.labels = assignment
+        order = np.argsort(assignment, kind="stable")
+        self.ids = order
+        self.matrix = np.ascontiguousarray(matrix[order])
+        counts = np.bincount(assignment, minlength=self.n_lists)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def updated(self, embeddings, previous_rows, normalized=False):
+        # Index over a new version of the matrix that keeps the trained
+        # centroids. previous_rows[i] is row i's position in the old matrix, or
+        # -1 for added/changed rows; only those are assigned to a list.
+        matrix = np.asarray(embeddings, dtype=np.float32) if normalized else normalize_rows(embeddings)
+        previous_rows = np.asarray(previous_rows, dtype=np.int64)
+        reused = previous_rows >= 0
+        labels = np.empty(matrix.shape[0], dtype=np.int64)
+        labels[reused] = self.labels[previous_rows[reused]]
+        labels[~reused] = self._assign(matrix[~reused])
+        return IVFIndex(matrix, n_probe=self.n_probe, normalized=True, centroids=self.centroids, labels=labels)
+
+    def _train(self, matrix, n_iter, seed):
+        if matrix.shape[0] == 0:
+            return np.zeros((1, matrix.shape[1]), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        sample = matrix[rng.choice(matrix.shape[0], size=min(matrix.shape[0], 256 * self.n_lists), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=self.n_lists) == 0
+            # Re-seed empty clusters so every list stays useful
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    def _assign(self, matrix, chunk=65536):
+        labels = np.empty(matrix.shape[0], dtype=np.int64)
+        for start in range(0, matrix.shape[0], chunk):
+            labels[start:start + chunk] = np.argmax(matrix[start:start + chunk] @ self.centroids.T, axis=1)
+        return labels
+
+    def search(self, queries, k=5, n_probe=None):
+        queries = normalize_rows(np.atleast_2d(queries))
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        probes, _ = top_k(queries @ self.centroids.T, n_probe)
+        indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for qi, query in enumerate(queries):
+            spans = [(self.offsets[p], self.offsets[p + 1]) for p in probes[qi]]
+            rows = np.concatenate([np.arange(start, end) for start, end in spans])
+            if len(rows) == 0:
+                continue
+            candidate_scores = np.concatenate([self.matrix[start:end] @ query for start, end in spans])
+            best, best_scores = top_k(candidate_scores[None, :], k)
+            indices[qi, :best.shape[1]] = self.ids[rows[best[0]]]
+            scores[qi, :best.shape[1]] = best_scores[0]
+        return indices, scores
+
+stopwords = frozenset("""a an and are as at be by can do does for from has have how i in is it its
+me my of on or the this to what when where which who why will with you your""".split())
+
+def terms(text):
+    return [term for term in re.findall(r"[a-z0-9]+", str(text).lower()) if term not in stopwords]
+
+class BM25Index:
+    # Okapi BM25 over a few text fields of every row, as an inverted index:
+    # term -> (row ids, weighted term frequency). A field weight of 2 counts
+    # each of its terms twice, so name hits outrank description hits.
+    # Product names are also indexed on their own for name_match().
+    def __init__(self, records, fields, weights=None, name_field="product_name", k1=1.2, b=0.75):
+        weights = weights or {}
+        self.k1 = k1
+        postings = {}
+        lengths = []
+        self.names = {}
+        self.max_name_terms = 0
+        row_names = []
+        name_rows = {}
+        other_terms = set()
+        for row, record in enumerate(records):
+            counts = {}
+            length = 0.0
+            for field in fields:
+                weight = weights.get(field, 1.0)
+                for term in terms(record.get(field, "")):
+                    counts[term] = counts.get(term, 0.0) + weight
+                    length += weight
+                    if field != name_field:
+                        other_terms.add(term)
+            for term, count in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(count)
+            lengths.append(length)
+            name_terms = terms(record.get(name_field, ""))
+            row_names.append(" ".join(name_terms))
+            if name_terms:
+                # The last row wins, like catalog.by_slug and the page fast path
+                self.names[" ".join(name_terms)] = row
+                self.max_name_terms = max(self.max_name_terms, len(name_terms))
+                for term in set(name_terms):
+                    name_rows.setdefault(term, set()).add(row)
+        self.n = len(lengths)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        average = float(lengths.mean()) if self.n and lengths.mean() > 0 else 1.0
+        # Per-row length normalisation, k1 * (1 - b + b * length / average)
+        self.norms = (k1 * (1 - b + b * lengths / average)).astype(np.float32)
+        self.postings = {}
+        for term, (rows, counts) in postings.items():
+            idf = math.log(1 + (self.n - len(rows) + 0.5) / (len(rows) + 0.5))
+            self.postings[term] = (np.asarray(rows, dtype=np.int64), np.asarray(counts, dtype=np.float32), idf)
+        # Name terms no other product uses in any field (rows repeating the
+        # same name count as one product). Those found in no other field of
+        # any row, e.g. a brand like "vistamax", are brand_terms; the rest are
+        # often plain nouns ("keyboard") the catalog happens to use once.
+        self.unique_name_terms = {}
+        for term, rows in name_rows.items():
+            names = {row_names[row] for row in self.postings[term][0].tolist()}
+            if len(names) == 1 and not term.isdigit():
+                self.unique_name_terms[term] = self.names[names.pop()]
+        self.brand_terms = frozenset(term for term in self.unique_name_terms if term not in other_terms)
+
+    def __len__(self):
+        return self.n
+
+    def scores(self, query):
+        scores = np.zeros(self.n, dtype=np.float32)
+        for term in set(terms(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, counts, idf = posting
+            scores[rows] += idf * counts * (self.k1 + 1) / (counts + self.norms[rows])
+        return scores
+
+    def search(self, query, k=5):
+        # (rows, scores) of the best k rows with any matching term
+        if self.n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, scores = top_k(self.scores(query)[None, :], k)
+        keep = scores[0] > 0
+        return rows[0][keep], scores[0][keep]
+
+    def name_match(self, query, min_unique_terms=2):
+        # Row whose product name the query names exactly: the longest full
+        # name contained in it, else name terms found in a single product
+        # only, all pointing at the same one: one brand term, or at least
+        # min_unique_terms of them. Any other single term may be a generic
+        # noun ("keyboard", "bottle") that just happens to appear once in the
+        # catalog. None when ambiguous or absent.
+        query_terms = terms(query)
+        for size in range(min(self.max_name_terms, len(query_terms)), 0, -1):
+            for start in range(len(query_terms) - size + 1):
+                row = self.names.get(" ".join(query_terms[start:start + size]))
+                if row is not None:
+                    return row
+        matched = {term for term in query_terms if term in self.unique_name_terms}
+        rows = {self.unique_name_terms[term] for term in matched}
+        if len(rows) == 1 and (len(matched) >= min_unique_terms or matched & self.brand_terms):
+            return rows.pop()
+        return None
+
+def fuse(dense_rows, dense_scores, lexical_rows, lexical_scores, weight):
+    # Convex mix of cosine similarity and BM25 scaled to [0, 1] by the best
+    # lexical hit. dense_scores must cover every row in either list
+    # (row -> cosine); returns the fused rows, best first.
+    lexical = {}
+    if len(lexical_scores) and lexical_scores.max() > 0:
+        lexical = dict(zip(lexical_rows.tolist(), (lexical_scores / lexical_scores.max()).tolist()))
+    rows = list(dict.fromkeys(list(dense_rows) + list(lexical)))
+    fused = [(1 - weight) * dense_scores[row] + weight * lexical.get(row, 0.0) for row in rows]
+    order = np.argsort(-np.asarray(fused), kind="stable")
+    return [rows[i] for i in order]
+
+def previous_rows(old_hashes, new_hashes):
+    # Position of every new row in the old matrix by content hash, -1 if new
+    old_positions = {h: i for i, h in enumerate(old_hashes)}
+    return [old_positions.get(h, -1) for h in new_hashes]
+
+def build_index(embeddings, backend="exact", normalized=False, **options):
+    if backend == "exact":
+        return DenseIndex(embeddings, normalized=normalized)
+    if backend == "ivf":
+        return IVFIndex(embeddings, normalized=normalized, **options)
+    raise ValueError(f"Unknown index backend: {backend}")
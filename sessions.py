@@ -0,0 +1,93 @@
+import uuid
+import threading
+from collections import deque
+
+import numpy as np
+
+import config
+from dialogue import get_dialogue_template
+from response_cache import TTLCache
+
+# Server-side chat memory. A browser session (id kept in a dcc.Store) has one
+# Conversation per chat page, and each turn is stored as the int32 token ids
+# of its rendered "<|user|> question <|end|> <|assistant|> answer <|end|>"
+# text, so follow-up prompts splice ids in without re-tokenizing history.
+# context_ids() keeps the newest turns that fit in the token budget; older
+# turns stay visible in the chat box but no longer reach the model. Sessions
+# expire after session_ttl_seconds without a request.
+
+class Turn:
+    def __init__(self, ids, answer_start):
+        self.ids = ids
+        self.answer_start = answer_start
+
+    def __len__(self):
+        return len(self.ids)
+
+class Conversation:
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self._lock = threading.Lock()
+
+    def add(self, tokenizer, question, answer):
+        template = get_dialogue_template()
+        question_ids = tokenizer(template.get_user_turn(question))['input_ids']
+        answer_ids = tokenizer(template.get_assistant_turn(answer))['input_ids']
+        turn = Turn(np.array(question_ids + answer_ids, dtype=np.int32), len(question_ids))
+        with self._lock:
+            self.turns.append(turn)
+
+    def context_ids(self, budget):
+        # Newest turns first until the budget is used up, returned oldest first
+        with self._lock:
+            turns = list(self.turns)
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            if used + len(turn) > budget:
+                break
+            kept.append(turn.ids)
+            used += len(turn)
+        if not kept:
+            return []
+        return np.concatenate(kept[::-1]).tolist()
+
+    def messages(self, tokenizer):
+        # (question, answer) text of every stored turn, for display
+        with self._lock:
+            turns = list(self.turns)
+        return [(tokenizer.decode(turn.ids[:turn.answer_start], skip_special_tokens=True).strip(),
+                 tokenizer.decode(turn.ids[turn.answer_start:], skip_special_tokens=True).strip())
+                for turn in turns]
+
+    def __len__(self):
+        return len(self.turns)
+
+class SessionStore:
+    def __init__(self, max_sessions, ttl_seconds, max_turns):
+        self.max_turns = max_turns
+        self._sessions = TTLCache(max_sessions, ttl_seconds)
+        self._lock = threading.Lock()
+
+    def conversation(self, session_id, page, create=True):
+        # The session's conversation on one page; touching it renews the session
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = {}
+            self._sessions.put(session_id, session)
+            if page not in session:
+                if not create:
+                    return None
+                session[page] = Conversation(self.max_turns)
+            return session[page]
+
+    def __len__(self):
+        return len(self._sessions)
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+store = SessionStore(config.max_sessions, config.session_ttl_seconds, config.session_max_turns)
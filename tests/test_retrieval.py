@@ -0,0 +1,34 @@
+import retrieval
+
+records = [
+    {"product_name": "VistaMax 4K Monitor", "description": "A 27 inch monitor with HDR."},
+    {"product_name": "Wireless Keyboard", "description": "A quiet keyboard for the office."},
+    {"product_name": "Gaming Monitor", "description": "A fast monitor for games."},
+    {"product_name": "Steel Water Bottle", "description": "A bottle that keeps water cold."},
+    {"product_name": "Wireless Keyboard", "description": "The same keyboard, listed again."},
+]
+
+def index():
+    return retrieval.BM25Index(records, ["description", "product_name"], {"product_name": 2.0})
+
+def test_full_name_matches():
+    assert index().name_match("What is the price of the Gaming Monitor?") == 2
+
+def test_repeated_name_matches_last_row():
+    assert index().name_match("is the wireless keyboard in stock") == 4
+
+def test_brand_alone_matches():
+    assert index().name_match("do you have a vistamax?") == 0
+    assert index().name_match("vistamax monitor") == 0
+
+def test_single_generic_term_does_not_match():
+    # "keyboard" and "bottle" name one product each but also appear in
+    # descriptions, so they read as nouns rather than names
+    assert index().name_match("do you have a keyboard?") is None
+    assert index().name_match("any bottle?") is None
+
+def test_two_unique_terms_match():
+    assert index().name_match("a water bottle") == 3
+
+def test_shared_term_does_not_match():
+    assert index().name_match("a monitor") is None
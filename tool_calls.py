@@ -0,0 +1,81 @@
+import re
+import ast
+import logging
+
+import metrics
+import orders
+
+# The user bot was trained to end an answer that takes an action with a call
+# such as initiate_refund('Gaming Laptop'), change_location('Smart Watch',
+# 'mumbai') or cancel_order('Compact Microwave'). parse() pulls those calls and
+# their arguments out of the answer text and run() executes one against the
+# order store, returning the line shown to the customer.
+
+logger = logging.getLogger(__name__)
+
+# tool -> its parameters in positional order
+tools = {
+    "initiate_refund": ["product_name"],
+    "change_location": ["product_name", "location"],
+    "cancel_order": ["product_name"],
+}
+
+call_pattern = re.compile(r"\b(" + "|".join(tools) + r")\s*\(([^()]*)\)")
+
+class ToolCall:
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments  # parameter -> str
+
+    def __repr__(self):
+        return f"ToolCall({self.name!r}, {self.arguments!r})"
+
+def _parse_arguments(text):
+    # Literal arguments, positional or by keyword; the model sometimes leaves
+    # the quotes off, then the text is split on commas
+    try:
+        call = ast.parse(f"f({text})", mode="eval").body
+        positional = [str(ast.literal_eval(arg)) for arg in call.args]
+        keywords = {keyword.arg: str(ast.literal_eval(keyword.value)) for keyword in call.keywords}
+        return positional, keywords
+    except (SyntaxError, ValueError):
+        parts = [part.strip().strip("'\"").strip() for part in text.split(",")]
+        return [part for part in parts if part], {}
+
+def parse(text):
+    calls = []
+    for match in call_pattern.finditer(str(text)):
+        name = match.group(1)
+        positional, keywords = _parse_arguments(match.group(2))
+        arguments = dict(zip(tools[name], positional))
+        arguments.update((key, value) for key, value in keywords.items() if key in tools[name])
+        calls.append(ToolCall(name, arguments))
+    return calls
+
+def _named_product(user_id, question, store):
+    # A call without a product name acts on the order the question names
+    question = orders.normalize_name(question)
+    names = {order["product_name"] for order in store.user_orders(user_id)
+             if orders.normalize_name(order["product_name"]) in question}
+    return names.pop() if len(names) == 1 else ""
+
+def run(call, user_id, question="", store=None):
+    store = store or orders.store
+    product_name = call.arguments.get("product_name") or _named_product(user_id, question, store)
+    try:
+        if call.name == "initiate_refund":
+            order = store.initiate_refund(user_id, product_name)
+            message = f"Refund started for the {order['product_name']}"
+        elif call.name == "change_location":
+            order = store.change_location(user_id, product_name, call.arguments.get("location", ""))
+            message = f"The {order['product_name']} will now be delivered to {order['location']}"
+        else:
+            order = store.cancel_order(user_id, product_name)
+            message = f"The {order['product_name']} order was cancelled"
+    except orders.OrderError as e:
+        metrics.tool_calls.inc(tool=call.name, outcome="rejected")
+        logger.info("%r rejected for %s: %s", call, user_id, e)
+        return f"Could not {call.name.replace('_', ' ')}: {e}"
+    metrics.tool_calls.inc(tool=call.name, outcome="done")
+    logger.info("%r done for %s", call, user_id)
+    return message
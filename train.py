@@ -0,0 +1,394 @@
+import os
+import math
+import time
+import random
+import contextlib
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import AdamW
+from torch.utils.data import RandomSampler
+from transformers import get_linear_schedule_with_warmup
+
+# Fine-tuning loop for the support bots (was finetune_gpt2 in the notebook).
+#   - grad_accum_steps micro-batches per optimizer step
+#   - precision "auto" uses bf16 autocast on GPUs that support it, fp32 elsewhere;
+#     "bf16", "fp16" (with loss scaling) and "fp32" force a mode
+#   - every checkpoint_every optimizer steps, model/optimizer/scheduler/scaler
+#     state, RNG states and the position in the epoch go to
+#     checkpoint_dir/last.pt; a rerun with the same data resumes from there
+#     and produces the same weights as an uninterrupted run
+#   - every log_every steps prints loss, learning rate and tokens/sec
+# Under torch.distributed (python -m train --nproc N, or torchrun) the model is
+# wrapped in DistributedDataParallel, each process reads its own shard of the
+# batches, and only rank 0 logs, evaluates and writes checkpoints. Resume with
+# the same number of processes.
+
+checkpoint_name = "last.pt"
+
+def autocast_dtype(device, precision="auto"):
+    # None means plain fp32
+    if precision == "auto":
+        if str(device).startswith("cuda") and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+            return torch.bfloat16
+        return None
+    if precision == "bf16":
+        return torch.bfloat16
+    if precision == "fp16":
+        return torch.float16
+    if precision == "fp32":
+        return None
+    raise ValueError(f"Unknown precision: {precision}")
+
+def set_loader_epoch(loader, epoch, seed=0):
+    # Makes each epoch's order depend only on (seed, epoch), so a resumed run
+    # sees the same batches
+    for sampler in (loader.batch_sampler, loader.sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+            return
+    if isinstance(loader.sampler, RandomSampler):
+        loader.sampler.generator = torch.Generator().manual_seed(seed + epoch)
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+def _all_reduce_sum(*values):
+    if not is_distributed():
+        return values
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals)
+    return tuple(totals.tolist())
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    # RNG states must be cpu ByteTensors whatever device the run is on
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state["cuda"]])
+
+def save_checkpoint(path, model, optimizer, scheduler, scaler, epoch, batches_done, step, total_steps):
+    # Called on every rank: each one contributes its RNG state, rank 0 writes.
+    # Written to a temp file and renamed, an interrupted save keeps the old one.
+    rng = rng_state()
+    if is_distributed():
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, rng)
+        rng = states
+    if is_main_process():
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict(),
+            "scaler": scaler.state_dict() if scaler is not None else None,
+            "epoch": epoch,
+            "batches_done": batches_done,
+            "step": step,
+            "total_steps": total_steps,
+            "rng": rng,
+        }, tmp_path)
+        os.replace(tmp_path, path)
+    if is_distributed():
+        dist.barrier()
+
+def load_checkpoint(path):
+    # Read onto the cpu: model and optimizer load_state_dict move tensors to
+    # the parameters' device, and the RNG states have to stay on the cpu
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if isinstance(checkpoint["rng"], list):
+        # One state per rank
+        rank = dist.get_rank() if is_distributed() else 0
+        checkpoint["rng"] = checkpoint["rng"][rank % len(checkpoint["rng"])]
+    return checkpoint
+
+def restore_checkpoint(checkpoint, model, optimizer, scheduler, scaler):
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    scheduler.load_state_dict(checkpoint["scheduler"])
+    if scaler is not None and checkpoint["scaler"] is not None:
+        scaler.load_state_dict(checkpoint["scaler"])
+
+def evaluate(model, loader, device, dtype=None):
+    model.eval()
+    total_loss = 0
+    batches = 0
+    with torch.no_grad():
+        for batch in loader:
+            labels = batch["labels"].to(device)
+            if (labels != -100).sum().item() == 0:
+                continue
+            with _autocast(device, dtype):
+                loss = model(batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device),
+                             labels=labels).loss
+            total_loss += loss.item()
+            batches += 1
+    model.train()
+    return total_loss / batches if batches else float("nan")
+
+def _autocast(device, dtype):
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+def finetune(model, tokenizer, train_loader, val_loader=None, epochs=4, learning_rate=5e-5, warmup_steps=1000,
+             max_grad_norm=1.0, grad_accum_steps=1, device="cuda", precision="auto", checkpoint_dir=None,
+             checkpoint_every=500, log_every=10, max_steps=0, seed=0, stats=None):
+    # stats: optional dict, filled with optimizer steps, tokens (all ranks) and seconds
+    if len(tokenizer) != model.get_input_embeddings().num_embeddings:
+        model.resize_token_embeddings(len(tokenizer))
+    model.to(device)
+    model.train()
+    distributed = is_distributed()
+    train_model = model
+    if distributed:
+        device_ids = [torch.device(device).index] if torch.device(device).type == "cuda" else None
+        train_model = DistributedDataParallel(model, device_ids=device_ids)
+
+    dtype = autocast_dtype(device, precision)
+    scaler = torch.amp.GradScaler(torch.device(device).type) if dtype == torch.float16 else None
+    optimizer = AdamW(model.parameters(), lr=learning_rate)
+    steps_per_epoch = math.ceil(len(train_loader) / grad_accum_steps)
+    total_steps = steps_per_epoch * epochs
+    if max_steps:
+        total_steps = min(total_steps, max_steps)
+    checkpoint_path = os.path.join(checkpoint_dir, checkpoint_name) if checkpoint_dir else None
+    checkpoint = None
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+        # A resumed run keeps the LR schedule it started with, even when
+        # epochs or max_steps are different this time (older checkpoints
+        # without total_steps use the one computed here)
+        total_steps = checkpoint.get("total_steps", total_steps)
+    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=warmup_steps,
+                                                num_training_steps=total_steps)
+
+    step = 0
+    start_epoch = 0
+    skip_batches = 0
+    resume_rng = None
+    if checkpoint is not None:
+        restore_checkpoint(checkpoint, model, optimizer, scheduler, scaler)
+        step, start_epoch, skip_batches = checkpoint["step"], checkpoint["epoch"], checkpoint["batches_done"]
+        resume_rng = checkpoint["rng"]
+        checkpoint = None  # a cpu copy of the weights, not kept for the whole run
+        if is_main_process():
+            print(f"Resuming from {checkpoint_path}: step {step}, epoch {start_epoch + 1}, batch {skip_batches}")
+        if max_steps and step >= max_steps:
+            return model, tokenizer
+    else:
+        torch.manual_seed(seed)
+
+    window_tokens = 0
+    window_loss = 0.0
+    window_batches = 0
+    window_start = time.perf_counter()
+    run_tokens = 0
+    run_start = time.perf_counter()
+
+    def finish():
+        if stats is not None:
+            stats["steps"] = step
+            stats["tokens"], = _all_reduce_sum(run_tokens)
+            stats["seconds"] = time.perf_counter() - run_start
+        return model, tokenizer
+
+    for epoch in range(start_epoch, epochs):
+        set_loader_epoch(train_loader, epoch, seed)
+        batches = iter(train_loader)
+        for _ in range(skip_batches):
+            next(batches)
+        batches_done = skip_batches
+        skip_batches = 0
+        if resume_rng is not None:
+            # After creating the iterator, which draws from the global RNG itself
+            set_rng_state(resume_rng)
+            resume_rng = None
+
+        micro_batches = 0
+        for batch in batches:
+            input_ids = batch["input_ids"].to(device)
+            labels = batch["labels"].to(device)
+            attention_mask = batch["attention_mask"].to(device)
+            batches_done += 1
+            micro_batches += 1
+            sync = micro_batches % grad_accum_steps == 0 or batches_done == len(train_loader)
+            # Gradients are only all-reduced on the micro-batch that steps
+            no_sync = train_model.no_sync() if distributed and not sync else contextlib.nullcontext()
+            has_targets = bool((labels != -100).any())
+            with no_sync:
+                with _autocast(device, dtype):
+                    if has_targets:
+                        loss = train_model(input_ids, attention_mask=attention_mask, labels=labels).loss
+                    else:
+                        # Nothing to predict (the loss would be nan); a zero
+                        # loss still joins the other ranks' all-reduce
+                        loss = train_model(input_ids, attention_mask=attention_mask).logits.sum() * 0.0
+                scaled = loss / grad_accum_steps
+                if scaler is not None:
+                    scaler.scale(scaled).backward()
+                else:
+                    scaled.backward()
+            if has_targets:
+                window_loss += loss.item()
+                window_batches += 1
+                tokens = int(attention_mask.sum())
+                window_tokens += tokens
+                run_tokens += tokens
+
+            if not sync:
+                continue
+            if scaler is not None:
+                scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+            step += 1
+
+            if log_every and step % log_every == 0:
+                elapsed = time.perf_counter() - window_start
+                tokens, loss_sum, loss_batches = _all_reduce_sum(window_tokens, window_loss, window_batches)
+                if is_main_process():
+                    print(f"epoch {epoch + 1} step {step}/{total_steps} loss {loss_sum / max(loss_batches, 1):.4f} "
+                          f"lr {scheduler.get_last_lr()[0]:.2e} {tokens / elapsed:.0f} tok/s")
+                window_tokens = window_batches = 0
+                window_loss = 0.0
+                window_start = time.perf_counter()
+            if checkpoint_path and checkpoint_every and step % checkpoint_every == 0:
+                save_checkpoint(checkpoint_path, model, optimizer, scheduler, scaler, epoch, batches_done, step,
+                                total_steps)
+            if max_steps and step >= max_steps:
+                if checkpoint_path:
+                    save_checkpoint(checkpoint_path, model, optimizer, scheduler, scaler, epoch, batches_done, step,
+                                    total_steps)
+                return finish()
+
+        if val_loader is not None:
+            if is_main_process():
+                print(f"Validation loss: {evaluate(model, val_loader, device, dtype):.4f}")
+            if distributed:
+                dist.barrier()
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, model, optimizer, scheduler, scaler, epoch + 1, 0, step, total_steps)
+    return finish()
+
+def init_distributed(rank, world_size, backend=None, port=29500):
+    # gloo runs anywhere (several CPU processes on one machine); nccl needs a GPU per rank
+    backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if backend == "gloo":
+        # Split the cores instead of every process using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    return backend
+
+def worker_device(device, rank):
+    if device.startswith("cuda") and torch.cuda.is_available():
+        return f"cuda:{rank % torch.cuda.device_count()}"
+    return device
+
+def run(args, rank=0, world_size=1):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    import training_data
+    from model_loading import resolve_device
+
+    device = worker_device(resolve_device(args.device), rank)
+    tokenizer = training_data.prepare_tokenizer(AutoTokenizer.from_pretrained(args.model))
+    if rank == 0:
+        training_data.ensure_token_cache(args.data, tokenizer, seq_length=args.seq_length)
+    if world_size > 1:
+        # Rank 0 tokenizes, the others then find the cache
+        dist.barrier()
+    train_loader, val_loader = training_data.get_dataloaders(args.data, tokenizer, args.seq_length, args.batch_size,
+                                                             mode=args.batching, seed=args.seed,
+                                                             num_replicas=world_size, rank=rank)
+    torch.manual_seed(args.seed)  # same initial weights on every rank
+    model = AutoModelForCausalLM.from_pretrained(args.model)
+    stats = {}
+    model, tokenizer = finetune(model, tokenizer, train_loader, val_loader, epochs=args.epochs,
+                                learning_rate=args.learning_rate, warmup_steps=args.warmup_steps,
+                                grad_accum_steps=args.grad_accum, device=device, precision=args.precision,
+                                checkpoint_dir=args.checkpoint_dir or args.output + "-checkpoint",
+                                checkpoint_every=args.checkpoint_every, max_steps=args.max_steps, seed=args.seed,
+                                stats=stats)
+    if rank == 0:
+        print(f"{stats['steps']} steps, {stats['tokens'] / stats['seconds']:.0f} tok/s over {world_size} "
+              f"process{'es' if world_size > 1 else ''}")
+        model.save_pretrained(args.output)
+        tokenizer.save_pretrained(args.output)
+    return stats
+
+def _spawned(rank, world_size, args, port):
+    init_distributed(rank, world_size, args.backend, port)
+    try:
+        run(args, rank, world_size)
+    finally:
+        dist.destroy_process_group()
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fine-tune a support bot on dialogue records")
+    parser.add_argument("data", help=".json/.jsonl training records")
+    parser.add_argument("--model", default="gpt2-medium")
+    parser.add_argument("--output", required=True, help="directory for the fine-tuned model and tokenizer")
+    parser.add_argument("--epochs", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=8, help="per process")
+    parser.add_argument("--grad-accum", type=int, default=1)
+    parser.add_argument("--learning-rate", type=float, default=5e-5)
+    parser.add_argument("--warmup-steps", type=int, default=1000)
+    parser.add_argument("--seq-length", type=int, default=1024)
+    parser.add_argument("--batching", default="bucketed", choices=["bucketed", "packed"],
+                        help="packed lets examples in a block attend to each other, see training_data.PackedDataset")
+    parser.add_argument("--precision", default="auto", choices=["auto", "bf16", "fp16", "fp32"])
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--checkpoint-dir", help="defaults to <output>-checkpoint")
+    parser.add_argument("--checkpoint-every", type=int, default=500)
+    parser.add_argument("--max-steps", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nproc", type=int, default=1, help="data-parallel processes to spawn on this machine")
+    parser.add_argument("--backend", help="torch.distributed backend, default nccl with cuda else gloo")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    #   python -m train train.jsonl --output ecom_bot_prod
+    #   python -m train train.jsonl --output ecom_bot_prod --nproc 4 --device cpu   (gloo)
+    #   torchrun --nproc-per-node 4 -m train train.jsonl --output ecom_bot_prod
+    args = parse_args()
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        rank, world_size = int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"])
+        init_distributed(rank, world_size, args.backend)
+        try:
+            run(args, rank, world_size)
+        finally:
+            dist.destroy_process_group()
+    elif args.nproc > 1:
+        torch.multiprocessing.spawn(_spawned, args=(args.nproc, args, free_port()), nprocs=args.nproc)
+    else:
+        run(args)
@@ -0,0 +1,303 @@
+import os
+import json
+import hashlib
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler, DistributedSampler
+
+import catalog_io
+from dialogue import get_dialogue_template
+
+# Training dialogues are rendered and tokenized once into a cache directory:
+#   tokens.bin      int32, every example's token ids back to back
+#   loss_mask.bin   uint8, 1 where the token is a training target
+#   offsets.npy     int64, example i is tokens[offsets[i]:offsets[i + 1]]
+#   meta.json       source file stamp, tokenizer and seq_length; written last
+# Epochs then read slices of the memory-mapped arrays. Examples are batched
+# with others of similar length ("bucketed", the default) and padded only to
+# the longest example in their batch. "packed" concatenates them into
+# seq_length blocks instead; see PackedDataset for what that changes.
+
+cache_version = 1
+pad_token = '<|pad|>'
+
+def prepare_tokenizer(tokenizer):
+    # Same additions as the fine-tuned bots: dialogue tokens and a pad token
+    template = get_dialogue_template()
+    tokenizer.add_special_tokens({'additional_special_tokens': template.get_special_tokens()})
+    tokenizer.add_special_tokens({'pad_token': pad_token})
+    return tokenizer
+
+def loss_mask(input_ids, tokenizer):
+    # Like DialogueDataset.mask_user_labels: system and user turns are context,
+    # everything from an assistant token on is trained
+    template = get_dialogue_template()
+    masking_ids = set(tokenizer.convert_tokens_to_ids([template.user_token, template.system_token]))
+    assistant_id = tokenizer.convert_tokens_to_ids(template.assistant_token)
+    mask = np.ones(len(input_ids), dtype=np.uint8)
+    masking = False
+    for i, token_id in enumerate(input_ids):
+        if token_id in masking_ids:
+            masking = True
+        elif token_id == assistant_id:
+            masking = False
+        if masking:
+            mask[i] = 0
+    return mask
+
+def _stamp(path, tokenizer, seq_length, max_samples):
+    stat = os.stat(path)
+    return {"version": cache_version, "source": os.path.abspath(path), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns, "tokenizer": tokenizer.name_or_path, "vocab_size": len(tokenizer),
+            "seq_length": seq_length, "max_samples": max_samples}
+
+def default_cache_dir(path, seq_length):
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:8]
+    return os.path.join("token_cache", f"{os.path.splitext(os.path.basename(path))[0]}-{seq_length}-{digest}")
+
+def build_token_cache(path, tokenizer, cache_dir, seq_length=1024, max_samples=0):
+    # Streams the records of path (.json/.jsonl/.cols), one pass, bounded memory
+    os.makedirs(cache_dir, exist_ok=True)
+    template = get_dialogue_template()
+    offsets = [0]
+    tmp = f".{os.getpid()}.tmp"
+    with open(os.path.join(cache_dir, "tokens.bin" + tmp), "wb") as tokens_file, \
+         open(os.path.join(cache_dir, "loss_mask.bin" + tmp), "wb") as mask_file:
+        for record in catalog_io.iter_records(path):
+            text = template.prepare_dialogue(record)['text']
+            input_ids = tokenizer(text, max_length=seq_length, truncation=True)['input_ids']
+            np.asarray(input_ids, dtype=np.int32).tofile(tokens_file)
+            loss_mask(input_ids, tokenizer).tofile(mask_file)
+            offsets.append(offsets[-1] + len(input_ids))
+            if max_samples and len(offsets) > max_samples:
+                break
+    for name in ("tokens.bin", "loss_mask.bin"):
+        os.replace(os.path.join(cache_dir, name + tmp), os.path.join(cache_dir, name))
+    np.save(os.path.join(cache_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    meta_path = os.path.join(cache_dir, "meta.json")
+    with open(meta_path + tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(_stamp(path, tokenizer, seq_length, max_samples), examples=len(offsets) - 1,
+                       tokens=offsets[-1]), f)
+    os.replace(meta_path + tmp, meta_path)
+    return TokenCache(cache_dir)
+
+def ensure_token_cache(path, tokenizer, cache_dir=None, seq_length=1024, max_samples=0):
+    # Reuses the cache unless the source file, tokenizer or seq_length changed
+    cache_dir = cache_dir or default_cache_dir(path, seq_length)
+    try:
+        cache = TokenCache(cache_dir)
+    except (OSError, ValueError):
+        cache = None
+    stamp = _stamp(path, tokenizer, seq_length, max_samples)
+    if cache is None or any(cache.meta.get(key) != value for key, value in stamp.items()):
+        print(f"Tokenizing {path} into {cache_dir}")
+        cache = build_token_cache(path, tokenizer, cache_dir, seq_length, max_samples)
+    return cache
+
+class TokenCache:
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy"))
+        if self.offsets[-1]:
+            self.tokens = np.memmap(os.path.join(cache_dir, "tokens.bin"), dtype=np.int32, mode="r")
+            self.mask = np.memmap(os.path.join(cache_dir, "loss_mask.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.tokens = np.empty(0, dtype=np.int32)
+            self.mask = np.empty(0, dtype=np.uint8)
+        if len(self.tokens) != self.offsets[-1] or len(self.mask) != self.offsets[-1]:
+            raise ValueError(f"{cache_dir}: token arrays do not match offsets")
+        self.lengths = np.diff(self.offsets)
+        # Trained tokens per example, 0 when truncation cut off the answer
+        self.targets = np.add.reduceat(self.mask, self.offsets[:-1], dtype=np.int64) if len(self.lengths) \
+            else np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def example(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.tokens[start:stop], self.mask[start:stop]
+
+def _example_dict(input_ids, mask):
+    input_ids = torch.from_numpy(np.asarray(input_ids, dtype=np.int64))
+    labels = input_ids.masked_fill(torch.from_numpy(np.asarray(mask) == 0), -100)
+    return {"input_ids": input_ids, "labels": labels}
+
+class TokenDataset(Dataset):
+    # One example per item, unpadded
+    def __init__(self, cache, indices=None):
+        self.cache = cache
+        self.indices = np.arange(len(cache)) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def lengths(self):
+        return self.cache.lengths[self.indices]
+
+    def __getitem__(self, idx):
+        return _example_dict(*self.cache.example(self.indices[idx]))
+
+class PackedDataset(Dataset):
+    # Whole examples concatenated into blocks of at most seq_length tokens,
+    # each going into the first of the last open_blocks blocks it fits in.
+    # Examples end with <|endoftext|>, but nothing else separates them: there
+    # is no per-example attention mask or position reset, so an example
+    # attends to the unrelated dialogues packed before it and starts at a
+    # shifted position, unlike at inference. Opt-in (mode="packed") for
+    # throughput experiments only.
+    def __init__(self, cache, indices=None, seq_length=1024, open_blocks=64):
+        self.cache = cache
+        indices = np.arange(len(cache)) if indices is None else np.asarray(indices)
+        self.blocks = []
+        free = []  # (room left, block) for blocks that may still take an example
+        for i in indices:
+            length = int(cache.lengths[i])
+            for slot, (room, block) in enumerate(free):
+                if length <= room:
+                    block.append(int(i))
+                    free[slot] = (room - length, block)
+                    break
+            else:
+                block = [int(i)]
+                self.blocks.append(block)
+                free.append((seq_length - length, block))
+                if len(free) > open_blocks:
+                    free.pop(0)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def lengths(self):
+        return np.array([self.cache.lengths[block].sum() for block in self.blocks])
+
+    def __getitem__(self, idx):
+        examples = [self.cache.example(i) for i in self.blocks[idx]]
+        return _example_dict(np.concatenate([ids for ids, _ in examples]),
+                             np.concatenate([mask for _, mask in examples]))
+
+class LengthBucketSampler(Sampler):
+    # Batches of similar length: shuffles, sorts each window of
+    # batch_size * window_batches examples by length, cuts it into batches
+    # and shuffles the batches. With num_replicas > 1 every rank gets the
+    # same number of batches, rank r taking batches r, r + num_replicas, ...
+    def __init__(self, lengths, batch_size, window_batches=50, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.window = batch_size * window_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return ((len(self.lengths) + self.batch_size - 1) // self.batch_size) // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.window):
+            window = order[start:start + self.window]
+            window = window[np.argsort(self.lengths[window], kind="stable")]
+            batches.extend(window[i:i + self.batch_size].tolist() for i in range(0, len(window), self.batch_size))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return iter(batches[self.rank:len(self) * self.num_replicas:self.num_replicas])
+
+class PadCollator:
+    # Pads to the longest item of the batch, not to seq_length
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items):
+        length = max(len(item["input_ids"]) for item in items)
+        input_ids = torch.full((len(items), length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(items), length), -100, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), length), dtype=torch.long)
+        for row, item in enumerate(items):
+            n = len(item["input_ids"])
+            input_ids[row, :n] = item["input_ids"]
+            labels[row, :n] = item["labels"]
+            attention_mask[row, :n] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+def split_indices(cache, val_fraction=0.1, seed=0):
+    # Examples without a single trained token are left out
+    order = np.random.default_rng(seed).permutation(len(cache))
+    order = order[cache.targets[order] > 0]
+    val_size = int(val_fraction * len(order))
+    return order[val_size:], order[:val_size]
+
+def make_dataset(cache, indices, mode="bucketed", seq_length=1024):
+    if mode == "packed":
+        return PackedDataset(cache, indices, seq_length)
+    if mode == "bucketed":
+        return TokenDataset(cache, indices)
+    raise ValueError(f"Unknown batching mode: {mode}")
+
+def make_dataloader(dataset, batch_size, pad_token_id, shuffle=True, seed=0, num_replicas=1, rank=0):
+    # Bucketed datasets get a LengthBucketSampler, packed ones plain (shuffled)
+    # batches; num_replicas > 1 shards either across distributed ranks
+    collate = PadCollator(pad_token_id)
+    if isinstance(dataset, TokenDataset):
+        return DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.lengths(), batch_size, shuffle=shuffle,
+                                                                      seed=seed, num_replicas=num_replicas,
+                                                                      rank=rank), collate_fn=collate)
+    if num_replicas > 1:
+        sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate)
+
+def get_dataloaders(path, tokenizer, seq_length=1024, batch_size=8, val_batch_size=1, mode="bucketed",
+                    val_fraction=0.1, max_samples=0, cache_dir=None, seed=0, num_replicas=1, rank=0):
+    # Only the training loader is sharded, validation runs on rank 0
+    cache = ensure_token_cache(path, tokenizer, cache_dir, seq_length, max_samples)
+    train_indices, val_indices = split_indices(cache, val_fraction, seed)
+    train_loader = make_dataloader(make_dataset(cache, train_indices, mode, seq_length), batch_size,
+                                   tokenizer.pad_token_id, shuffle=True, seed=seed, num_replicas=num_replicas,
+                                   rank=rank)
+    val_loader = make_dataloader(make_dataset(cache, val_indices, mode, seq_length), val_batch_size,
+                                 tokenizer.pad_token_id, shuffle=False, seed=seed)
+    return train_loader, val_loader
+
+def padding_report(loader):
+    # (batches, real tokens, tokens computed including padding)
+    batches = real = computed = 0
+    for batch in loader:
+        batches += 1
+        real += int(batch["attention_mask"].sum())
+        computed += batch["input_ids"].numel()
+    return batches, real, computed
+
+if __name__ == "__main__":
+    import argparse
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Pre-tokenize a training file and compare batching modes")
+    parser.add_argument("data", help=".json/.jsonl training records")
+    parser.add_argument("--tokenizer", default="gpt2-medium")
+    parser.add_argument("--seq-length", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--cache-dir")
+    args = parser.parse_args()
+
+    tokenizer = prepare_tokenizer(AutoTokenizer.from_pretrained(args.tokenizer))
+    cache = ensure_token_cache(args.data, tokenizer, args.cache_dir, args.seq_length)
+    print(f"{len(cache)} examples, {cache.offsets[-1]} tokens, longest {cache.lengths.max() if len(cache) else 0}")
+    fixed = len(cache) * args.seq_length
+    print(f"{'mode':>10}{'batches':>9}{'computed':>11}{'padding':>9}")
+    print(f"{'max_length':>10}{(len(cache) + args.batch_size - 1) // args.batch_size:>9}{fixed:>11}"
+          f"{1 - cache.offsets[-1] / max(fixed, 1):>9.1%}")
+    for mode in ("bucketed", "packed"):
+        loader = make_dataloader(make_dataset(cache, None, mode, args.seq_length), args.batch_size,
+                                 tokenizer.pad_token_id)
+        batches, real, computed = padding_report(loader)
+        print(f"{mode:>10}{batches:>9}{computed:>11}{1 - real / max(computed, 1):>9.1%}")